@@ -13,7 +13,92 @@ Created by Maximillian Dornseif on 2009-09-03.
 Copyright (c) 2009, 2010 HUDORA. All rights reserved.
 """
 
+import bisect
+import os.path
 import unittest
+from pyshipping.carriers.dpd.georoute import ROUTETABLES_BASE, _readfile
+from pyshipping.carriers.dpd.georoute import get_postcoderules, normalize_postcode
+
+
+class PostcodeIndex(object):
+    """Known postcodes per country, built from the DPD routing tables.
+
+    For each country the postcodes and postcode ranges found in the ROUTES and LOCATION files are kept
+    as sorted, non overlapping ranges, so a lookup is a binary search.
+    """
+
+    def __init__(self, path=ROUTETABLES_BASE):
+        ranges = {}
+        self.countries = set()
+        for line in _readfile(os.path.join(path, 'ROUTES')):
+            country, begin, end = line[:3]
+            self.countries.add(country)
+            if begin:
+                ranges.setdefault(country, []).append((begin, end or begin))
+        for language in ('DE', 'EN', 'FR'):
+            filename = os.path.join(path, 'LOCATION.' + language)
+            if os.path.exists(filename) or os.path.exists(filename + '.gz'):
+                for line in _readfile(filename):
+                    country, postcode = line[2:4]
+                    self.countries.add(country)
+                    if postcode:
+                        ranges.setdefault(country, []).append((postcode, postcode))
+        self.begins = {}
+        self.ends = {}
+        for country, countryranges in ranges.items():
+            countryranges.sort()
+            begins, ends = [], []
+            for begin, end in countryranges:
+                if ends and begin <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    begins.append(begin)
+                    ends.append(end)
+            self.begins[country] = begins
+            self.ends[country] = ends
+
+    def check(self, country, postcode):
+        """Checks if postcode is known for country.
+
+        Returns True or False, or None if we have no postcode information for country. The postcode is
+        expected without spaces and in upper case.
+        """
+        begins = self.begins.get(country)
+        if begins is None:
+            return None
+        pos = bisect.bisect_right(begins, postcode) - 1
+        return pos >= 0 and postcode <= self.ends[country][pos]
+
+
+_postcode_index = None
+
+
+def get_postcode_index():
+    """Returns the PostcodeIndex built from the routing tables shipped with pyShipping."""
+    global _postcode_index
+    if _postcode_index is None:
+        _postcode_index = PostcodeIndex()
+    return _postcode_index
+
+
+def _check(land, plz, index):
+    """Checks land and plz. Returns (status, message, land, plz) with normalized land and plz."""
+    rules = get_postcoderules()
+    normland, normplz = normalize_postcode(land, plz)
+    if not normplz:
+        if rules.needs_postcode(normland):
+            return ('10invalid', 'Postleitzahl fehlt', normland, normplz)
+    elif not rules.check_format(normland, normplz):
+        return ('10invalid', 'Postleitzahl fehlerhaft', normland, normplz)
+    if index is not None and normplz:
+        if normland not in index.countries:
+            return ('20troubled', 'Land unbekannt', normland, normplz)
+        if index.check(normland, normplz) is False:
+            return ('20troubled', 'Postleitzahl unbekannt', normland, normplz)
+    # upper casing and removing spaces is no correction, 'GU14 8HN' is fine in an address
+    if normland != land.upper() or normplz != plz.replace(' ', '').upper():
+        return ('31ok', 'Postleitzahl korrigiert', normland, normplz)
+    return ('30ok', '', normland, normplz)
 
 
 def validate(adr, servicelevel=1):
@@ -23,7 +108,7 @@ def validate(adr, servicelevel=1):
         - see http://cybernetics.hudora.biz/projects/wiki/AddressProtocol
     'servicelevel' can be an integer with the following values:
     1 - generic validation, no money/effort should be spend on correction and suggestions
-    2 - TBD.
+    2 - additionally check the postcode against the DPD routing tables (see PostcodeIndex)
 
     returns (status, message, [corrected addresses and variants])
 
@@ -35,16 +120,30 @@ def validate(adr, servicelevel=1):
     '40verified' - we are sure it works
     """
 
+    adr = dict(adr)
     adr['land'] = adr['land'].strip()
     adr['plz'] = adr['plz'].strip()
+    index = None
+    if servicelevel >= 2:
+        index = get_postcode_index()
+    status, message, land, plz = _check(adr['land'], adr['plz'], index)
+    if status == '31ok':
+        adr['land'], adr['plz'] = land, plz
+    return (status, message, [adr])
 
-    if adr['land'] != 'IE' and not adr['plz']:
-        return ('10invalid', 'Postleitzahl fehlt', [adr])
 
-    if adr['land'] == 'DE' and len(adr.get('plz', '')) != 5:
-        return ('10invalid', 'Postleitzahl fehlerhaft', [adr])
+def validate_many(addresses, servicelevel=2):
+    """Validates many addresses, e.g. a whole customer master file.
 
-    return ('30ok', '', [adr])
+    'addresses' can be any iterable of objects conforming to the address protocol, they are not
+    modified. This is a generator yielding a tuple (status, message) for each address, see validate()
+    for the meaning of status and servicelevel.
+    """
+    index = None
+    if servicelevel >= 2:
+        index = get_postcode_index()
+    for adr in addresses:
+        yield _check(adr['land'].strip(), adr['plz'].strip(), index)[:2]
 
 
 class AddressvalidationTests(unittest.TestCase):
@@ -83,6 +182,59 @@ class AddressvalidationTests(unittest.TestCase):
         self.address['plz'] = '12345 Rade'
         self.assertEqual(validate(self.address)[0], '10invalid')
 
+    def test_not_modified(self):
+        """The address passed to validate() is not changed."""
+        self.address['plz'] = ' 42897 '
+        self.assertEqual(validate(self.address)[2][0]['plz'], '42897')
+        self.assertEqual(self.address['plz'], ' 42897 ')
+
+    def test_postcode_index(self):
+        """Postcodes are checked against the routing tables."""
+        self.assertEqual(validate(self.address, servicelevel=2)[0], '30ok')
+        self.address['plz'] = '00001'
+        self.assertEqual(validate(self.address)[0], '30ok')
+        self.assertEqual(validate(self.address, servicelevel=2)[0], '20troubled')
+        index = get_postcode_index()
+        self.assertEqual(index.check('DE', '42477'), True)
+        self.assertEqual(index.check('GB', 'GU148HN'), True)
+        self.assertEqual(index.check('IE', '2'), True)
+        self.assertEqual(index.check('IE', '3'), False)
+        self.assertEqual(index.check('LI', '9495'), None)
+        self.assertEqual(index.check('XX', '9495'), None)
+
+    def test_corrected(self):
+        """Country prefixes are removed from the postcode."""
+        self.address['plz'] = 'D-42897'
+        self.assertEqual(validate(self.address)[:2], ('31ok', 'Postleitzahl korrigiert'))
+        self.assertEqual(validate(self.address)[2][0]['plz'], '42897')
+        self.address['plz'] = 'A-1210'
+        status, message, addresses = validate(self.address, servicelevel=2)
+        self.assertEqual(status, '31ok')
+        self.assertEqual((addresses[0]['land'], addresses[0]['plz']), ('AT', '1210'))
+
+    def test_own_prefix(self):
+        """Postcodes starting with the country code (Jersey, Isle of Man, Andorra) are fine."""
+        for land, plz in [('JE', 'JE2 3AB'), ('IM', 'IM1 1AD'), ('AD', 'AD500')]:
+            self.address['land'], self.address['plz'] = land, plz
+            self.assertEqual(validate(self.address)[:2], ('30ok', ''))
+        self.assertEqual(validate(self.address, servicelevel=2)[0], '30ok')
+        self.address['land'], self.address['plz'] = 'IM', 'IM1 1AD'
+        self.assertEqual(validate(self.address, servicelevel=2)[0], '30ok')
+
+    def test_validate_many(self):
+        """Test bulk validation."""
+        addresses = [{'land': 'DE', 'plz': '42897'}, {'land': 'DE', 'plz': ' 123'},
+                     {'land': 'GB', 'plz': 'GU14 8HN'}, {'land': 'GB', 'plz': '$$$'},
+                     {'land': 'LI', 'plz': '9495 '}, {'land': 'XX', 'plz': '9495'},
+                     {'land': 'IE', 'plz': ''}, {'land': 'AT', 'plz': ''},
+                     {'land': 'HK', 'plz': ''}, {'land': 'DE', 'plz': 'DE-00001'}]
+        self.assertEqual([status for status, message in validate_many(addresses)],
+                         ['30ok', '10invalid', '30ok', '10invalid', '30ok', '20troubled', '30ok', '10invalid',
+                          '30ok', '20troubled'])
+        self.assertEqual(addresses[1]['plz'], ' 123')
+        self.assertEqual([status for status, message in validate_many(addresses, servicelevel=1)],
+                         ['30ok', '10invalid', '30ok', '10invalid', '30ok', '30ok', '30ok', '10invalid',
+                          '30ok', '31ok'])
 
 if __name__ == '__main__':
     unittest.main()
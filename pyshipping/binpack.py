@@ -15,6 +15,10 @@ def binpack(packages, bin=None, iterlimit=5000):
     return binpack_simple.binpack(packages, bin, iterlimit)
 
 
+def binpack_stream(packages, bin=None, window=20, toobig=None):
+    return binpack_simple.binpack_stream(packages, bin, window, toobig)
+
+
 def test(func):
     import time
     from package import Package
@@ -43,6 +47,8 @@ def test(func):
 if __name__ == '__main__':
     print "py",
     test(binpack)
+    print "stream",
+    test(lambda packages: (list(binpack_stream(packages)), []))
 
 
 import time
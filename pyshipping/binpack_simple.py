@@ -211,6 +211,50 @@ def binpack(packages, bin=None, iterlimit=5000):
     return allpermutations(packages, bin, iterlimit)
 
 
+def binpack_stream(packages, bin=None, window=20, toobig=None):
+    """Packs an iterable of Package() objects into bins while they arrive.
+
+    This is a generator yielding each bin (as a list of packages) as soon as it is closed. At most
+    `window` packages are held back: when the window is full the waiting packages are packed with
+    packit() and the fullest resulting bin is closed, since waiting longer is unlikely to improve it.
+    When the input is exhausted all remaining bins are yielded.
+
+    Packages which don't fit into bin at all are appended to the list `toobig`. If no such list is
+    given a ValueError is raised for them.
+
+    >>> [len(x) for x in binpack_stream([Package('300x200x200')] * 9, window=4)]
+    [4, 4, 1]
+    >>> [len(x) for x in binpack_stream([Package.of('300x200x200')] * 20, window=10)]
+    [8, 8, 4]
+    """
+    if not bin:
+        bin = Package("600x400x400")
+    if window < 1:
+        raise ValueError("window must be at least 1")
+    waiting = []
+    for package in packages:
+        if package not in bin:
+            if toobig is None:
+                raise ValueError("%r does not fit into %r" % (package, bin))
+            toobig.append(package)
+            continue
+        waiting.append(package)
+        if len(waiting) >= window:
+            bins, rest = packit(bin, waiting)
+            fullest = max(bins, key=lambda packed: sum([x.volume for x in packed]))
+            # the same Package object may be waiting more than once, so remove one occurrence per packed one
+            for packed in fullest:
+                for i, x in enumerate(waiting):
+                    if x is packed:
+                        del waiting[i]
+                        break
+            yield fullest
+    if waiting:
+        bins, rest = packit(bin, waiting)
+        for packed in bins:
+            yield packed
+
+
 def test():
     fd = open('testdata.txt')
     vorher = 0
@@ -9,21 +9,35 @@ Copyright 2006, 2007 HUDORA GmbH. Published under a BSD License.
 
 import os
 import os.path
+import array
+import glob
 import gzip
+import hashlib
+import json
 import logging
+import re
+import shutil
 import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from collections import namedtuple
+from pyshipping.postcode import CARCODES, FORMATS, PostcodeRules
 
 
 ROUTETABLES_BASE = os.path.join(os.path.split(os.path.abspath(__file__))[0], 'georoutetables')
 ROUTES_DB_BASE = '/tmp/dpdroutes'
+# stored as PRAGMA user_version, databases with another schema version are rebuilt
+ROUTES_DB_SCHEMA = 5
+# ids of routes are line numbers times ROUTE_ID_GAP, leaving room for routes added by import_routes()
+ROUTE_ID_GAP = 1024
+# bytes read at once from routing tables, for gzipped tables before decompression
+TABLE_BLOCKSIZE = 256 * 1024
 
 
-# Quelle: http://de.wikipedia.org/wiki/Liste_der_Kfz-Nationalitätszeichen
-ISO2CAR = {
-    'AT': 'A',
-    'BE': 'B',
-    'FR': 'F',
-}
+# kept for compatibility, see pyshipping.postcode
+ISO2CAR = CARCODES
 
 
 class InvalidFormatError(Exception):
@@ -66,6 +80,11 @@ class NoRouteError(GeorouteException):
     pass
 
 
+class TableExpiredError(GeorouteException):
+    """The routing tables are past their expiration date."""
+    pass
+
+
 class Parcel(object):
     """Parcel destination data."""
 
@@ -90,25 +109,15 @@ class Destination(object):
         self.postcode = postcode
 
 
-class Route:
-    """Output of the routing algorithm."""
-
-    def __init__(self, d_depot, o_sort, d_sort, grouping_priority, barcode_id,
-                 iata_code, service_text, service_mark, country, serviceinfo, countrynum,
-                 routingtable_version, postcode):
-        self.d_depot = d_depot
-        self.o_sort = o_sort
-        self.d_sort = d_sort
-        self.grouping_priority = grouping_priority
-        self.barcode_id = barcode_id
-        self.iata_code = iata_code
-        self.service_text = service_text
-        self.service_mark = service_mark
-        self.country = country
-        self.serviceinfo = serviceinfo
-        self.countrynum = countrynum
-        self.routingtable_version = routingtable_version
-        self.postcode = postcode
+class Route(namedtuple('Route', 'd_depot o_sort d_sort grouping_priority barcode_id iata_code service_text '
+                       'service_mark country serviceinfo countrynum routingtable_version postcode')):
+    """Output of the routing algorithm.
+
+    Routes are immutable tuples without a __dict__ per instance, vars(route) still returns the fields as
+    dict. to_bytes() and to_json() serialize them for caches and other processes.
+    """
+
+    __slots__ = ()
 
     def __unicode__(self):
         output = u"""Output parameters:
@@ -132,75 +141,497 @@ Service Text: %s""" % (self.country, self.d_depot, self.o_sort, self.d_sort,
         return output
 
     def __repr__(self):
-        return repr(vars(self))
+        return repr(dict(vars(self)))
 
     def routingdata(self):
         return {'o_sort': self.o_sort, 'd_sort': self.d_sort,
                 'd_depot': self.d_depot, 'country': self.country,
                 'service_text': self.service_text, 'serviceinfo': self.serviceinfo}
 
+    def to_bytes(self):
+        """Serialize to a compact string, see from_bytes()."""
+        return '\0'.join([(field or u'').encode('utf-8') for field in self])
 
-def _readfile(filename):
-    """Read file line-by-line skipping comments."""
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a Route from the output of to_bytes(). All fields are unicode afterwards."""
+        return cls._make(data.decode('utf-8').split(u'\0'))
+
+    def to_json(self):
+        """Serialize to a JSON object with the field names as keys."""
+        return json.dumps(vars(self))
+
+    @classmethod
+    def from_json(cls, data):
+        """Create a Route from the output of to_json()."""
+        fields = json.loads(data)
+        return cls._make([fields[name] for name in cls._fields])
+
+
+def _open_table(filename):
+    """Open a routing table, the gzipped version is used if it exists."""
     if os.path.exists(filename + '.gz'):
-        fhandle = gzip.GzipFile(filename + '.gz')
+        return gzip.GzipFile(filename + '.gz')
+    return open(filename, 'rb')
+
+
+def _table_blocks(filename, blocksize=TABLE_BLOCKSIZE):
+    """Read a routing table in large blocks, each ending with a complete line.
+
+    Gzipped tables are decompressed block by block, which is much faster than reading a GzipFile line
+    by line. Like GzipFile, all members of concatenated gzip files are read.
+    """
+    gzipped = os.path.exists(filename + '.gz')
+    if gzipped:
+        infile = open(filename + '.gz', 'rb')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
     else:
-        fhandle = file(filename)
-    for line in fhandle:
-        line = line.strip().decode('latin1')
-        if line.startswith('#'):
-            continue
-        yield line.split('|')
+        infile = open(filename, 'rb')
+    rest = ''
+    with infile:
+        while True:
+            data = infile.read(blocksize)
+            if not data:
+                break
+            if gzipped:
+                compressed, data = data, ''
+                while compressed:
+                    data += decompressor.decompress(compressed)
+                    compressed = decompressor.unused_data
+                    if not compressed.strip('\0'):
+                        # GzipFile ignores zero padding after the last member as well
+                        break
+                    # the next member of a concatenated gzip file
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = rest + data
+            end = data.rfind('\n') + 1
+            rest = data[end:]
+            if end:
+                yield data[:end]
+    if rest:
+        yield rest
+
+
+def _table_lines(filename):
+    """Read the undecoded lines of a routing table skipping comments and empty lines."""
+    for block in _table_blocks(filename):
+        for line in block.split('\n'):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def _split_line(line):
+    """Split an undecoded line of a routing table into its fields."""
+    return line.decode('latin1').strip().split('|')
+
+
+def _readfile(filename):
+    """Read file line-by-line skipping comments and empty lines, yields a list of fields per line.
+
+    Every block is decoded at once, unicode.split() does the rest.
+    """
+    for block in _table_blocks(filename):
+        for line in block.decode('latin1').split('\n'):
+            line = line.strip()
+            if line and line[0] != '#':
+                yield line.split('|')
+
+
+def read_header(filename):
+    """Return the header fields (Version, Expiration, Hash, ...) of a routing table as a dict."""
+    header = {}
+    for line in _open_table(filename):
+        if not line.startswith('#'):
+            break
+        if ':' in line:
+            key, value = line[1:].split(':', 1)
+            header[key.strip()] = value.strip()
+    return header
+
+
+def table_hash(filename):
+    """Return the SHA-1 of the data lines of a routing table, as given in the #Hash: header."""
+    sha = hashlib.sha1()
+    for block in _table_blocks(filename):
+        if block.startswith('#') or '\n#' in block:
+            block = ''.join([line for line in block.splitlines(True) if not line.startswith('#')])
+        sha.update(block)
+    return sha.hexdigest()
+
+
+def _table_fields(header, name):
+    """Return the field names listed in a header line like #Fields: or #Key:."""
+    return [field for field in header.get(name, '').split('|') if field]
+
+
+class RoutesDiff(object):
+    """Differences between two versions of the ROUTES table.
+
+    Lines are identified by the fields listed in the #Key: header. A line whose key is found in both
+    versions with other values counts as changed and is also listed in deleted and inserted.
+
+    deleted is a list of (line number in the old table, line), inserted a list of (position, line) where
+    position is the number of unchanged lines before the line in the new table. ordered is False if the
+    unchanged lines are not in the same order in both tables, the diff can't be applied then.
+    """
+
+    # values reported by sort_changes()
+    SORT_FIELDS = ('D-Depot', 'O-Sort', 'D-Sort')
+
+    def __init__(self, oldfilename, newfilename):
+        header = read_header(newfilename)
+        self.fields = _table_fields(header, 'Fields')
+        keyfields = _table_fields(header, 'Key')
+        if not keyfields or keyfields != _table_fields(read_header(oldfilename), 'Key'):
+            raise InvalidFormatError("%s and %s have no common #Key:" % (oldfilename, newfilename))
+        keyindexes = [self.fields.index(field) for field in keyfields]
+
+        # compare the undecoded lines, only differing lines are split into fields
+        keylength = max(keyindexes) + 1
+        old = {}
+        self.old_count = 0
+        for line in _table_lines(oldfilename):
+            fields = line.split('|', keylength)
+            old[tuple([fields[i] for i in keyindexes])] = (self.old_count, line)
+            self.old_count += 1
+
+        self.inserted = []
+        self.changed = []
+        kept = []
+        for line in _table_lines(newfilename):
+            fields = line.split('|', keylength)
+            key = tuple([fields[i] for i in keyindexes])
+            oldline = old.pop(key, None)
+            if oldline is not None and oldline[1] == line:
+                kept.append(oldline[0])
+                continue
+            if oldline is not None:
+                old[key] = oldline
+                self.changed.append((key, _split_line(oldline[1]), _split_line(line)))
+            self.inserted.append((len(kept), _split_line(line)))
+        self.deleted = sorted([(number, _split_line(line)) for number, line in old.values()])
+        self.kept = kept
+        self.ordered = kept == sorted(kept)
+
+    def __len__(self):
+        """Number of deleted and inserted lines."""
+        return len(self.deleted) + len(self.inserted)
+
+    def sort_changes(self):
+        """Return (country, begin postcode, end postcode, field, old value, new value) for routes whose
+        D-Depot or sort codes changed."""
+        indexes = [(field, self.fields.index(field)) for field in self.SORT_FIELDS]
+        changes = []
+        for key, oldline, newline in self.changed:
+            for field, i in indexes:
+                if oldline[i] != newline[i]:
+                    changes.append((oldline[0], oldline[1], oldline[2], field, oldline[i], newline[i]))
+        return changes
+
+    def postcodes(self):
+        """Return the sorted (country, begin postcode, end postcode) of all deleted or inserted lines.
+
+        Routes to these postcodes might have changed. An empty begin postcode means the whole country.
+        """
+        return sorted(set([tuple(line[:3]) for position, line in self.deleted + self.inserted]))
+
+    def affects(self, country, postcode):
+        """Check if routes to the normalized country and postcode might have changed, e.g. to decide
+        which cached routes are still valid."""
+        for changedcountry, begin, end in self.postcodes():
+            if changedcountry == country and (not begin or begin <= postcode <= (end or begin)):
+                return True
+        return False
+
+    def apply(self, db):
+        """Delete and insert the changed routes in the routes table of db.
+
+        Routes keep the order of the new table. Returns False without changing anything if the diff
+        can't be applied, e.g. because db wasn't built from the old table.
+        """
+        cur = db.cursor()
+        cur.execute("SELECT id FROM routes ORDER BY id")
+        ids = [row[0] for row in cur.fetchall()]
+        if not self.ordered or len(ids) != self.old_count:
+            return False
+
+        # number the inserted lines evenly between the unchanged lines around them
+        newrows = []
+        i = 0
+        while i < len(self.inserted):
+            position = self.inserted[i][0]
+            run = [line for pos, line in self.inserted[i:] if pos == position]
+            before = 0
+            if position:
+                before = ids[self.kept[position - 1]]
+            if position < len(self.kept):
+                after = ids[self.kept[position]]
+            else:
+                after = before + ROUTE_ID_GAP * (len(run) + 1)
+            step = (after - before) // (len(run) + 1)
+            if step < 1:
+                logging.info("no room for %d new routes, the routes table has to be rebuilt", len(run))
+                return False
+            for j, line in enumerate(run):
+                newrows.append((before + step * (j + 1), line))
+            i += len(run)
+
+        cur.execute("SELECT expression, id FROM routingplaces")
+        routingplaces = dict(cur.fetchall())
+        cur.executemany("DELETE FROM routes WHERE id=?", [(ids[number], ) for number, line in self.deleted])
+        for routeid, line in newrows:
+            places = routingplaces.get(line[4])
+            if places is None:
+                places = routingplaces[line[4]] = len(routingplaces) + 1
+                cur.execute('INSERT INTO routingplaces VALUES (?,?)', (places, line[4]))
+            cur.execute('INSERT INTO routes VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+                        [routeid] + line[:3] + [_expand_services(line[3]), places] + line[5:-1])
+        db.commit()
+        return True
+
+
+def diff_routes(oldfilename, newfilename):
+    """Compare two versions of the ROUTES table, see RoutesDiff."""
+    return RoutesDiff(oldfilename, newfilename)
+
+
+def _expand_services(services):
+    """Expand a ServiceCodes list like 'S101,S136139' to '101,136,137,138,139'."""
+    services_list = []
+    for service in services.split(','):
+        if len(service) > 4:
+            start = int(service[1:4])
+            end = int(service[4:])
+            for i in range(start, end + 1):
+                services_list.append(unicode(i))
+        else:
+            services_list.append(service[1:])
+
+    return ','.join(services_list)
+
+
+_postcoderules = None
+
+
+def get_postcoderules():
+    """Returns the PostcodeRules for all countries in the COUNTRY table."""
+    global _postcoderules
+    if _postcoderules is None:
+        # FlagPostCodeNo is 1 for countries without postcodes
+        _postcoderules = PostcodeRules([(line[1], line[4] != '1')
+                                        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'COUNTRY'))])
+    return _postcoderules
+
+
+NORMALIZE_CACHE_SIZE = 10000
+_normalized = {}
+
+
+def normalize_postcode(country, postcode):
+    """Returns the cleaned up (country, postcode) tuple, see PostcodeRules.normalize().
+
+    Results are cached since an order stream contains the same postcodes over and over again.
+    """
+    key = (country, postcode)
+    ret = _normalized.get(key)
+    if ret is None:
+        if len(_normalized) >= NORMALIZE_CACHE_SIZE:
+            _normalized.clear()
+        ret = _normalized[key] = get_postcoderules().normalize(country, postcode)
+    return ret
+
+
+# umlauts are folded the german way, other accents are just removed
+_FOLDINGS = {u'ä': u'ae', u'ö': u'oe', u'ü': u'ue', u'ß': u'ss'}
+# candidates offered by CityIndex.lookup()
+CITY_MIN_SIMILARITY = 0.4
+# a city without exact match is only routed to a candidate this similar and ahead of the next one by
+# CITY_MARGIN, everything else is too likely the wrong town
+CITY_ACCEPT_SIMILARITY = 0.7
+CITY_MARGIN = 0.2
+
+
+def fold_city(name):
+    """Folds case, umlauts, accents and punctuation of a city name.
+
+    >>> fold_city('Saint-Etienne ')
+    u'saint etienne'
+    """
+    if not isinstance(name, unicode):
+        try:
+            name = name.decode('utf-8')
+        except UnicodeDecodeError:
+            name = name.decode('latin1')
+    name = name.lower()
+    for umlaut, replacement in _FOLDINGS.items():
+        name = name.replace(umlaut, replacement)
+    name = unicodedata.normalize('NFKD', name)
+    return u' '.join(u''.join([char if char.isalnum() else u' ' for char in name
+                               if not unicodedata.combining(char)]).split())
+
+
+def _trigrams(folded):
+    padded = u'  %s ' % folded
+    return set([padded[i:i + 3] for i in range(len(padded) - 2)])
+
+
+class CityIndex(object):
+    """City name to postcode lookup built from all LOCATION.* files.
+
+    City names are compared after fold_city(). Names which don't match exactly are found by the
+    similarity of their trigrams.
+    """
+
+    def __init__(self, path=ROUTETABLES_BASE):
+        self.entries = []  # (country, folded city, city, postcode)
+        self.exact = {}  # (country, folded city) -> entry numbers
+        self.trigrams = {}  # (country, trigram) -> entry numbers
+        seen = set()
+        filenames = set([filename[:-3] if filename.endswith('.gz') else filename
+                         for filename in glob.glob(os.path.join(path, 'LOCATION.*'))])
+        for filename in sorted(filenames):
+            for line in _readfile(filename):
+                area, city, country, postcode = line[:4]
+                city = city or area
+                country = country.upper()
+                folded = fold_city(city)
+                if (country, folded, postcode) in seen:
+                    continue
+                seen.add((country, folded, postcode))
+                number = len(self.entries)
+                self.entries.append((country, folded, city, postcode))
+                self.exact.setdefault((country, folded), []).append(number)
+                for trigram in _trigrams(folded):
+                    self.trigrams.setdefault((country, trigram), []).append(number)
+
+    def lookup(self, city, country, limit=5):
+        """Returns up to limit (score, postcode, city) tuples for city in country, best match first.
+
+        Exact matches score 1.0, others the trigram similarity, at least CITY_MIN_SIMILARITY.
+        """
+        if not city or not country:
+            return []
+        country = country.upper()
+        folded = fold_city(city)
+        candidates = [(1.0, number) for number in self.exact.get((country, folded), [])]
+        if not candidates:
+            trigrams = _trigrams(folded)
+            common = {}
+            for trigram in trigrams:
+                for number in self.trigrams.get((country, trigram), ()):
+                    common[number] = common.get(number, 0) + 1
+            for number, count in common.items():
+                score = float(count) / (len(trigrams) + len(_trigrams(self.entries[number][1])) - count)
+                if score >= CITY_MIN_SIMILARITY:
+                    candidates.append((score, number))
+            candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        ret = []
+        postcodes = set()
+        for score, number in candidates:
+            postcode, name = self.entries[number][3], self.entries[number][2]
+            if postcode not in postcodes:
+                postcodes.add(postcode)
+                ret.append((score, postcode, name))
+        return ret[:limit]
+
+    def translate(self, city, country):
+        """Returns the postcode for city in country, raises TranslationError if there is no clear match."""
+        candidates = self.lookup(city, country)
+        if candidates:
+            score = candidates[0][0]
+            if score == 1.0 or (score >= CITY_ACCEPT_SIMILARITY
+                                and (len(candidates) == 1 or score - candidates[1][0] >= CITY_MARGIN)):
+                return candidates[0][1]
+            names = ' or '.join([name for score, postcode, name in candidates])
+            raise TranslationError("Cannot find postcode for location %s, %s, did you mean %s?"
+                                   % (city, country, names))
+        raise TranslationError("Cannot find postcode for location %s, %s" % (city, country))
 
 
 class RouteData(object):
     """More convenient representation of the georoute data."""
 
-    def __init__(self, routingdepot='0142'):
-        """Routingdepot the depot from where you are sending."""
+    def __init__(self, routingdepot='0142', path=ROUTETABLES_BASE):
+        """Routingdepot the depot from where you are sending by default, path the directory with the
+        routing tables.
+
+        The data doesn't depend on the routing depot, a Router can route for any depot, see
+        usable_routingplaces().
+        """
         self.routingdepot = routingdepot
         self.routingdepotgroups = ''
         self.routingdepotcountry = ''
-
-        services = os.path.join(ROUTETABLES_BASE, 'SERVICE')
-        self.version = None
-        for line in file(services):
-            if line.startswith('#Version: '):
-                self.version = line.split(':')[1].strip()
-                break
+        self._usable_routingplaces = {}
+        self.path = path
+        # set by RouteDataManager.load() if the routes were imported from the previous tables
+        self.routes_diff = None
+        # version of the previous tables if all other tables are unchanged, so routes not affected by
+        # routes_diff are the same
+        self.diff_version = None
+
+        header = read_header(os.path.join(path, 'SERVICE'))
+        self.version = header.get('Version')
+        self.expiration = header.get('Expiration')
         if self.version is None:
             raise InvalidFormatError("There's no version in the SERVICE file")
 
         self.countries = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'COUNTRY')):
+        for line in _readfile(os.path.join(path, 'COUNTRY')):
             isonum, isoname = line[:2]
             self.countries[isoname.upper()] = isonum
 
         self.depots = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'DEPOTS')):
+        for line in _readfile(os.path.join(path, 'DEPOTS')):
             geopostdepotnumber = line[0]
             self.depots[geopostdepotnumber] = tuple(line)
 
         self.services = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'SERVICE')):
+        for line in _readfile(os.path.join(path, 'SERVICE')):
             servicecode = line[0]
             self.services[servicecode] = tuple(line)
 
         self.serviceinfo = {}
-        for line in _readfile(os.path.join(ROUTETABLES_BASE, 'SERVICEINFO.DE')):
+        for line in _readfile(os.path.join(path, 'SERVICEINFO.DE')):
             servicecode = line[0]
             self.serviceinfo[servicecode] = line[1]
 
-        filename = ROUTES_DB_BASE + ('-%s-%s.db' % (routingdepot, self.version))
-        self.db = sqlite3.connect(filename)
+        filename = ROUTES_DB_BASE + ('-%s.db' % self.version)
+        # RouteDataManager builds RouteData in a background thread
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+
+        self.upgrade_schema()
+        self.read_depots(path)
+        self.read_routes(path)
+        self.db.execute("PRAGMA user_version=%d" % ROUTES_DB_SCHEMA)
+        self.cities = CityIndex(path)
+
+    def expired(self, today=None):
+        """Check if the tables are past their expiration date. today is a YYYYMMDD string."""
+        if not self.expiration:
+            return False
+        return (today or time.strftime('%Y%m%d')) > self.expiration
 
-        self.read_depots(ROUTETABLES_BASE)
-        self.read_locations(ROUTETABLES_BASE)
-        self.read_routes(ROUTETABLES_BASE)
+    def upgrade_schema(self):
+        """Drop the routing tables if they were built with an older schema, read_routes() rebuilds them."""
+        c = self.db.cursor()
+        c.execute("PRAGMA user_version")
+        if c.fetchone()[0] != ROUTES_DB_SCHEMA:
+            logging.info("upgrading routes database schema")
+            c.execute("DROP TABLE IF EXISTS routes")
+            c.execute("DROP TABLE IF EXISTS routedepots")
+            c.execute("DROP TABLE IF EXISTS routingplaces")
+        # cities are looked up in CityIndex, databases of older versions still have a location table
+        c.execute("DROP TABLE IF EXISTS location")
 
     def read_depots(self, path):
         """Read DEPOTS file and save all the information in a
         SQLite database."""
+        if self.routingdepot in self.depots:
+            self.routingdepotgroups = self.depots[self.routingdepot][2]
+            self.routingdepotgrouplist = self.routingdepotgroups.split(',')
+            self.routingdepotcountry = self.depots[self.routingdepot][9]
+
         c = self.db.cursor()
 
         c.execute("""SELECT COUNT(*)
@@ -228,34 +659,14 @@ class RouteData(object):
                 c.execute("""INSERT INTO depots
                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                           line[:14])
-                if line[0] == self.routingdepot:
-                    self.routingdepotgroups = line[2]
-                    self.routingdepotgrouplist = line[2].split(',')
-                    self.routingdepotcountry = line[9]
-            c.execute('VACUUM;')
-
-    def read_locations(self, path):
-        """Read LOCATION file and save all the information in a SQLite database."""
-        c = self.db.cursor()
-
-        c.execute("""SELECT COUNT(*)
-                     FROM sqlite_master
-                     WHERE type='table' AND name='location'""")
-        if not c.fetchone()[0]:
-            logging.info("regenerating location table")
-            c.execute("""CREATE TABLE location
-            (Area TEXT,
-             City TEXT,
-             Country TEXT,
-             Postcode TEXT)""")
-
-            for line in _readfile(os.path.join(path, 'LOCATION.DE')):
-                c.execute('INSERT INTO location VALUES (?,?,?,?)',
-                          line[:4])
             c.execute('VACUUM;')
 
     def read_routes(self, path):
-        """Read ROUTES file and save all the information in a SQLite database."""
+        """Read ROUTES file and save all the information in a SQLite database.
+
+        Each distinct RoutingPlaces expression is stored once in the routingplaces table, routes refer
+        to it by id.
+        """
         # self.db = sqlite3.connect(ROUTES_DB)
         c = self.db.cursor()
 
@@ -270,85 +681,92 @@ class RouteData(object):
             BeginPostCode TEXT,
             EndPostCode TEXT,
             ServiceCodes TEXT,
-            RoutingPlaces TEXT,
+            RoutingPlaces INTEGER,
             SendingDate TEXT,
             OSort TEXT,
             DDepot TEXT,
             GroupingPriority TEXT,
             DSort TEXT,
             BarcodeID TEXT)""")
-
-            c.execute("""SELECT COUNT(*)
-                         FROM sqlite_master
-                         WHERE type='table' AND name='routedepots'""")
-            if not c.fetchone()[0]:
-                logging.info("regenerating routedepots table")
-                c.execute("""CREATE TABLE routedepots
-                (route INTEGER,
-                 depot TEXT)""")
+            c.execute("""CREATE TABLE routingplaces
+            (id INTEGER PRIMARY KEY,
+             expression TEXT)""")
 
             c.execute("PRAGMA synchronous=OFF;")
             c.execute("PRAGMA temp_store=MEMORY;")
-            i = 1
+            # ids follow the line numbers, so routes stay in file order
+            i = ROUTE_ID_GAP
+            routingplaces = {}
             for line in _readfile(os.path.join(path, 'ROUTES')):
+                places = routingplaces.get(line[4])
+                if places is None:
+                    # check the syntax once for every expression
+                    self.routingplaces_match(line[4], self.routingdepot)
+                    places = routingplaces[line[4]] = len(routingplaces) + 1
+                    c.execute('INSERT INTO routingplaces VALUES (?,?)', (places, line[4]))
                 services = self.expand_services(line[3])
                 c.execute('INSERT INTO routes VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
-                          [i] + line[:3] + [services] + line[4:-1])
-                self.expand_depots(i, line[4], c)
-                i += 1
-
-            c.execute("CREATE INDEX routes_DestinationCountry ON routes(DestinationCountry)")
-            c.execute("CREATE INDEX routes_BeginPostCode ON routes(BeginPostCode)")
-            c.execute("CREATE INDEX routes_EndPostCode ON routes(EndPostCode)")
-            c.execute("CREATE INDEX routedepots_route ON routedepots(route)")
-            c.execute("CREATE INDEX routedepots_depot ON routedepots(depot)")
+                          [i] + line[:3] + [services, places] + line[5:-1])
+                i += ROUTE_ID_GAP
+
+            # all routing queries filter on country and postcode together
+            c.execute("""CREATE INDEX routes_country_postcodes
+                         ON routes(DestinationCountry, BeginPostCode, EndPostCode)""")
+            c.execute('ANALYZE;')
             c.execute('VACUUM;')  # also commits the database
+            usable, total = self.count_routes(self.routingdepot)
+            logging.info("%d of %d routes (%.1f%%) are usable from routing depot %s", usable, total,
+                         100.0 * usable / max(total, 1), self.routingdepot)
 
     def expand_services(self, services):
         """Expand services list."""
-        services_list = []
-        for service in services.split(','):
-            if len(service) > 4:
-                start = int(service[1:4])
-                end = int(service[4:])
-                for i in range(start, end + 1):
-                    services_list.append(unicode(i))
-            else:
-                services_list.append(service[1:])
-
-        return ','.join(services_list)
-
-    def expand_depots(self, route, depots, c):
-        """Parse depots list and generate route->depots relationship."""
-        # but only four "our" depot.
-        # if you change the self.routingdepot, you have to rebuild the database
-        if depots == '':
-            c.execute("""INSERT INTO routedepots(route, depot) VALUES (?, ?)""", (route, depots))
-            return
-
-        for depot in depots.split(','):
-            if depot.startswith('C'):
-                if depot[1:] == self.routingdepotcountry:
-                    c.execute("""INSERT INTO routedepots(route, depot) VALUES(?, ?)""", (route,
-                                                                                         self.routingdepot))
-            elif depot.startswith('D'):
-                if len(depot) > 5:
-                    start = int(depot[1:5])
-                    end = int(depot[5:])
-                    for i in range(start, end + 1):
-                        if ("%04d" % i) == self.routingdepot:
-                            c.execute("""INSERT INTO routedepots(route, depot) VALUES(?, ?)""",
-                                      (route, self.routingdepot))
-                else:
-                    if depot[1:5] == self.routingdepot:
-                        c.execute("""INSERT INTO routedepots(route, depot) VALUES(?, ?)""",
-                                  (route, depot[1:5]))
-            elif depot.startswith('G'):
-                if depot[1:] in self.routingdepotgroups:
-                    c.execute("INSERT INTO routedepots(route, depot) VALUES(?, ?)",
-                              (route, self.routingdepot))
+        return _expand_services(services)
+
+    def routingplaces_match(self, routingplaces, depot):
+        """Check if the RoutingPlaces of a route include depot, i.e. if it can be used from there."""
+        if routingplaces == '':
+            return True
+
+        depotdata = self.get_depot(depot)
+        groups = depotdata[2].split(',')
+        country = depotdata[9]
+        found = False
+        for place in routingplaces.split(','):
+            if place.startswith('C'):
+                if place[1:] == country:
+                    found = True
+            elif place.startswith('D'):
+                if len(place) > 5:
+                    if int(place[1:5]) <= int(depot) <= int(place[5:]):
+                        found = True
+                elif place[1:5] == depot:
+                    found = True
+            elif place.startswith('G'):
+                if place[1:] in groups:
+                    found = True
             else:
-                raise InvalidFormatError("Unable to parse depot '%s'" % depot)
+                raise InvalidFormatError("Unable to parse depot '%s'" % place)
+        return found
+
+    def usable_routingplaces(self, depot):
+        """Return the set of routingplaces ids of routes which can be used from depot."""
+        places = self._usable_routingplaces.get(depot)
+        if places is None:
+            cur = self.db.cursor()
+            cur.execute("SELECT id, expression FROM routingplaces")
+            places = frozenset([placesid for placesid, expression in cur.fetchall()
+                                if self.routingplaces_match(expression, depot)])
+            self._usable_routingplaces[depot] = places
+        return places
+
+    def count_routes(self, depot):
+        """Return the number of routes usable from depot and the number of all routes."""
+        usable = self.usable_routingplaces(depot)
+        cur = self.db.cursor()
+        cur.execute("SELECT RoutingPlaces, COUNT(*) FROM routes GROUP BY RoutingPlaces")
+        counts = cur.fetchall()
+        return (sum([count for places, count in counts if places in usable]),
+                sum([count for places, count in counts]))
 
     def get_countrynum(self, isoname):
         """Return country ISO code."""
@@ -374,66 +792,259 @@ class RouteData(object):
             return ''
         return self.serviceinfo[servicecode]
 
+    def locate(self, city, country, limit=5):
+        """Return a ranked list of (score, postcode, city) candidates, see CityIndex.lookup()."""
+        return self.cities.lookup(city, country, limit)
+
     def translate_location(self, city, country):
-        """Return postcode for given city and country."""
-        cur = self.db.cursor()
-        cur.execute("SELECT Postcode FROM location WHERE City=? AND Country=?", (city, country))
-        rows = cur.fetchall()
-        if not rows:
-            raise TranslationError("Cannot find postcode for location %s, %s" % (city, country))
-        return rows[0][0]
+        """Return postcode for given city and country, see CityIndex.translate()."""
+        return self.cities.translate(city, country)
+
+
+def import_routes(oldpath, newpath):
+    """Build the routes database for the tables in newpath from the one of the tables in oldpath.
+
+    Only the lines of the ROUTES table which differ between both versions are deleted and inserted, the
+    other tables are rebuilt by RouteData and PrecomputedRouter. Returns the RoutesDiff or None if there
+    is nothing to import from, the database for newpath exists already or the diff can't be applied.
+    RouteData builds the database from scratch then.
+    """
+    oldversion = read_header(os.path.join(oldpath, 'SERVICE')).get('Version')
+    newversion = read_header(os.path.join(newpath, 'SERVICE')).get('Version')
+    olddb = ROUTES_DB_BASE + ('-%s.db' % oldversion)
+    newdb = ROUTES_DB_BASE + ('-%s.db' % newversion)
+    if oldversion == newversion or os.path.exists(newdb) or not os.path.exists(olddb):
+        return None
+
+    diff = diff_routes(os.path.join(oldpath, 'ROUTES'), os.path.join(newpath, 'ROUTES'))
+    tempdb = newdb + '.import'
+    shutil.copyfile(olddb, tempdb)
+    db = sqlite3.connect(tempdb)
+    try:
+        cur = db.cursor()
+        cur.execute("PRAGMA user_version")
+        applied = cur.fetchone()[0] == ROUTES_DB_SCHEMA and diff.apply(db)
+        if applied:
+            cur.execute("DROP TABLE IF EXISTS depots")
+            # RouteTables of the old version
+            cur.execute("DROP TABLE IF EXISTS precomputed")
+            cur.execute('ANALYZE;')
+            db.commit()
+    finally:
+        db.close()
+    if not applied:
+        os.remove(tempdb)
+        return None
+    os.rename(tempdb, newdb)
+    logging.info("imported %d changed routes from %s into %s", len(diff), oldversion, newversion)
+    return diff
+
+
+# The routing path uses only these statements. As the SQL never changes, sqlite3 keeps them prepared in its
+# statement cache. Routes matching the postcode exactly, by range and the catch all routes of a country are
+# tried in this order.
+_COUNTRY_QUERY = "SELECT 1 FROM routes WHERE DestinationCountry=? LIMIT 1"
+_POSTCODE_QUERIES = (
+    "SELECT * FROM routes WHERE DestinationCountry=:country AND BeginPostCode=:postcode",
+    """SELECT * FROM routes
+       WHERE DestinationCountry=:country AND BeginPostCode<=:postcode AND EndPostCode>=:postcode""",
+    "SELECT * FROM routes WHERE DestinationCountry=:country AND BeginPostCode=''")
+# names of the _POSTCODE_QUERIES in RouteStats
+POSTCODE_MATCHES = ('exact', 'range', 'country')
+
+
+class RouteStats(object):
+    """Counters and timings collected by Routers and get_route(), see enable_stats().
+
+    Counters are kept by name and an optional label, e.g. ('postcode', 'range') counts parcels routed by
+    a postcode range because no route for the exact postcode exists. Timings are kept per routing stage.
+    """
+
+    # Prometheus label names of labelled counters
+    LABELS = {'errors': 'exception', 'cache': 'result', 'postcode': 'match', 'service': 'match',
+              'service_any': 'match'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, label=None):
+        """Increase the counter name, label e.g. distinguishes fallbacks."""
+        with self.lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + 1
+
+    def stage(self, name, start):
+        """Record the time spent in stage name since start, returns the current time."""
+        now = time.time()
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += now - start
+        return now
+
+    def cache_hit_rate(self):
+        """Return the fraction of get_route() calls answered from the cache or None."""
+        hits = self.counters.get(('cache', 'hit'), 0)
+        total = hits + self.counters.get(('cache', 'miss'), 0)
+        if not total:
+            return None
+        return float(hits) / total
+
+    def as_dict(self):
+        """Return all counters and timings as flat dict, e.g. {'postcode_range': 12, 'stage_postcode_seconds':
+        0.0012, 'stage_postcode_count': 15, ...}."""
+        with self.lock:
+            stats = {}
+            for (name, label), value in self.counters.items():
+                stats[label and '%s_%s' % (name, label) or name] = value
+            for name, (count, seconds) in self.timings.items():
+                stats['stage_%s_count' % name] = count
+                stats['stage_%s_seconds' % name] = seconds
+        stats['cache_hit_rate'] = self.cache_hit_rate()
+        return stats
+
+    def prometheus(self, prefix='georoute'):
+        """Return all counters and timings in the Prometheus text exposition format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+        lines = []
+        names = []
+        for (name, label), value in counters:
+            metric = '%s_%s_total' % (prefix, name)
+            if metric not in names:
+                names.append(metric)
+                lines.append('# TYPE %s counter' % metric)
+            if label:
+                metric += '{%s="%s"}' % (self.LABELS.get(name, 'label'), label)
+            lines.append('%s %d' % (metric, value))
+        if timings:
+            metric = '%s_stage_seconds' % prefix
+            lines.append('# TYPE %s summary' % metric)
+            for name, (count, seconds) in timings:
+                lines.append('%s_sum{stage="%s"} %f' % (metric, name, seconds))
+                lines.append('%s_count{stage="%s"} %d' % (metric, name, count))
+        return '\n'.join(lines) + '\n'
+
+
+_stats = None
+
+
+def enable_stats(stats=None):
+    """Collect statistics of all Routers and get_route() in stats or a new RouteStats, which is returned.
+
+    A single Router can be instrumented by setting its stats attribute instead.
+    """
+    global _stats
+    _stats = stats or RouteStats()
+    return _stats
+
+
+def disable_stats():
+    """Stop collecting statistics, the overhead of Routers is reduced to a few checks then."""
+    global _stats
+    _stats = None
+
+
+def get_stats():
+    """Return the RouteStats set by enable_stats() or None."""
+    return _stats
 
 
 class Router(object):
-    """Routes parcels."""
+    """Routes parcels sent from routingdepot, by default the routingdepot of data.
 
-    def __init__(self, data):
+    Several Routers for different depots can share one RouteData object.
+    """
+
+    # RouteStats for this Router only, see enable_stats()
+    stats = None
+
+    def __init__(self, data, routingdepot=None):
         self.route_data = data
         self.db = self.route_data.db
+        self.conditions = ['1=1']
+        self.routingdepot = routingdepot or data.routingdepot
+        self.usable_routingplaces = data.usable_routingplaces(self.routingdepot)
 
     def route(self, parcel):
-        """Find route."""
-
+        """Find route. parcel is not modified."""
+        stats = self.stats or _stats
+        if stats is None:
+            return self._route(parcel, None)
+        start = time.time()
+        try:
+            route = self._route(parcel, stats)
+        except GeorouteException, exception:
+            stats.count('errors', exception.__class__.__name__)
+            raise
+        stats.count('routes')
+        stats.stage('total', start)
+        return route
+
+    def _route(self, parcel, stats):
+        """Find route, recording timings and fallbacks in stats unless it is None."""
+        if stats is not None:
+            stamp = time.time()
         self.current_subset = []
-        self.conditions = ['1=1']
-        self.cleanup_postcode(parcel)
+        self.postcode_subsets = {}
+        country, postcode = normalize_postcode(parcel.country, parcel.postcode)
+        parcel = Destination(country, postcode, parcel.city, parcel.service)
 
         self.select_country(parcel)
+        if stats is not None:
+            stamp = stats.stage('country', stamp)
         if parcel.postcode is None:
             parcel.postcode = self.route_data.translate_location(parcel.city, parcel.country)
-            self.subsetstack.append(self.subset)
+            if stats is not None:
+                stats.count('city_lookups')
+                stamp = stats.stage('city', stamp)
 
         self.select_postcode(parcel)
+        if stats is not None:
+            stats.count('postcode', POSTCODE_MATCHES[self.postcode_level])
+            stamp = stats.stage('postcode', stamp)
         self.select_service(parcel)
+        if stats is not None:
+            stats.count(self.service_any and 'service_any' or 'service', POSTCODE_MATCHES[self.service_level])
+            stamp = stats.stage('service', stamp)
         self.select_depot(parcel)
+        if stats is not None:
+            if len(self.current_subset) < len(self.service_subset):
+                stats.count('depot_filtered')
+            stamp = stats.stage('depot', stamp)
         # Sending date is not used yet, according to documentation
 
         # If there are several routes, always use the first one.
         # In prior versions, an exception was raised instead.
-        if len(self.current_subset) >= 1:
-            rows = self.select_routes("1=1")
-            (service_text, service_mark) = self.route_data.get_service(parcel.service)[1:3]
-            depot = self.route_data.get_depot(rows[0][8])
-            iata_code = depot[1]
-            country = depot[9]
-            if not country:
-                country = parcel.country
-            serviceinfo = self.route_data.get_servicetext(parcel.service)
-
-            return Route(rows[0][8], rows[0][7], rows[0][10], rows[0][9], rows[0][11],
-                         iata_code, service_text, service_mark, country,
-                         serviceinfo, self.route_data.get_countrynum(country),
-                         self.route_data.version, parcel.postcode)
-        raise NoRouteError("No route found for %r|%r|%r" % \
-              (parcel.country, parcel.postcode, parcel.service))
+        # postcode_subset() only returns routes usable from the routing depot, so the first route matching
+        # postcode and service is taken, select_depot() just double checks.
+        row = self.service_subset[0]
+        (service_text, service_mark) = self.route_data.get_service(parcel.service)[1:3]
+        depot = self.route_data.get_depot(row[8])
+        iata_code = depot[1]
+        country = depot[9]
+        if not country:
+            country = parcel.country
+        serviceinfo = self.route_data.get_servicetext(parcel.service)
+
+        route = Route(row[8], row[7], row[10], row[9], row[11],
+                      iata_code, service_text, service_mark, country,
+                      serviceinfo, self.route_data.get_countrynum(country),
+                      self.route_data.version, parcel.postcode)
+        if stats is not None:
+            stats.stage('result', stamp)
+        return route
 
     def add_condition(self, condition):
         self.conditions.append(condition)
 
     def select_routes(self, condition, params=()):
-        """Find routes matching condition and currently selected subset of the routes table.
-        If routes are found, save their ids for narrowing future searches.
-        If no routes are found, do not change current subset.
+        """Find routes matching condition and the conditions in self.conditions.
+        If routes are found, add condition to self.conditions for narrowing future searches.
+
+        This is a helper for interactive use, route() doesn't use it.
         """
 
         subsetcondition = ' AND '.join(self.conditions)
@@ -448,161 +1059,427 @@ class Router(object):
         return rows
 
     def select_country(self, parcel):
-        """Select all routes with the given country."""
-        rows = self.select_routes("DestinationCountry='%s'" % (parcel.country.upper().replace("'", ''), ))
-        if not rows:
+        """Check that there are routes for the given country."""
+        cur = self.db.cursor()
+        cur.execute(_COUNTRY_QUERY, (parcel.country, ))
+        if not cur.fetchall():
             raise CountryError("Country %s unknown" % parcel.country)
 
     def cleanup_postcode(self, parcel):
-        """Removes spaces and country prefixes from postcodes."""
+        """Removes spaces and country prefixes from postcodes, see normalize_postcode()."""
 
         if not parcel.postcode:
             return
-        parcel.postcode = parcel.postcode.replace(' ', '').strip()
-        if parcel.postcode.startswith('-'):
-            parcel.postcode = parcel.postcode[1:]
-            self.cleanup_postcode(parcel)
-        if parcel.postcode.upper().startswith(parcel.country.upper()):
-            parcel.postcode = parcel.postcode[len(parcel.country):]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() in ISO2CAR:
-            if parcel.postcode.upper().startswith(ISO2CAR[parcel.country.upper()]):
-                parcel.postcode = parcel.postcode[len(ISO2CAR[parcel.country.upper()]):]
-                self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('CH-'):
-            parcel.country = 'CH'
-            parcel.postcode = parcel.postcode[2:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('BE-'):
-            parcel.country = 'BE'
-            parcel.postcode = parcel.postcode[2:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('B-'):
-            parcel.country = 'BE'
-            parcel.postcode = parcel.postcode[1:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('AT-'):
-            parcel.country = 'AT'
-            parcel.postcode = parcel.postcode[2:]
-            self.cleanup_postcode(parcel)
-        if parcel.country.upper() == 'DE' and parcel.postcode.upper().startswith('A-'):
-            parcel.country = 'AT'
-            parcel.postcode = parcel.postcode[1:]
-            self.cleanup_postcode(parcel)
+        parcel.country, parcel.postcode = normalize_postcode(parcel.country, parcel.postcode)
+
+    def postcode_subset(self, parcel, level):
+        """Return the routes matching the postcode exactly (level 0), by range (1) or the catch all routes
+        of the country (2) which are usable from the routing depot, ordered like the ROUTES file.
+        Results are kept for the current parcel."""
+        rows = self.postcode_subsets.get(level)
+        if rows is None:
+            cur = self.db.cursor()
+            cur.execute(_POSTCODE_QUERIES[level], {'country': parcel.country, 'postcode': parcel.postcode})
+            usable = self.usable_routingplaces
+            rows = self.postcode_subsets[level] = sorted([row for row in cur.fetchall() if row[5] in usable])
+        return rows
 
     def select_postcode(self, parcel):
         """Select all routes matching the given postcode."""
-
-        # direct match
-        rows = self.select_routes("BeginPostCode='%s'" % parcel.postcode.replace("'", ''))
-        if not rows:
-            # range
-            rows = self.select_routes("BeginPostCode<='%s' AND EndPostCode>='%s'"
-                                       % (parcel.postcode.replace("'", ''), parcel.postcode.replace("'", '')))
-        if not rows:
-            # catch all
-            rows = self.select_routes("BeginPostCode=''")
-        if not rows:
-            raise NoRouteError("Postcode %r|%r unknown" % (parcel.country, parcel.postcode))
+        for level in range(len(_POSTCODE_QUERIES)):
+            self.current_subset = self.postcode_subset(parcel, level)
+            if self.current_subset:
+                self.postcode_level = level
+                return
+        raise NoRouteError("Postcode %r|%r unknown" % (parcel.country, parcel.postcode))
 
     def select_service(self, parcel):
         """Select all routes with the given service code."""
 
-        # we have to redo postcode query as a backoff strategy
-        self.conditions.pop()
-        postcodequeries = ["BeginPostCode='%s'" % parcel.postcode.replace("'", ''),
-            "BeginPostCode<='%s' AND EndPostCode>='%s'" % (parcel.postcode.replace("'", ''),
-                                                           parcel.postcode.replace("'", '')),
-            "BeginPostCode=''"]
-        for postcodequery in postcodequeries:
-            rows = self.select_routes("%s AND ServiceCodes LIKE '%%%s%%'" % (postcodequery, parcel.service))
-            if not rows:
+        # we have to redo postcode selection as a backoff strategy
+        for level in range(len(_POSTCODE_QUERIES)):
+            rows = self.postcode_subset(parcel, level)
+            # ServiceCodes is a comma separated list, this matches like the LIKE '%service%' used before
+            self.current_subset = [row for row in rows if parcel.service in row[4]]
+            self.service_any = not self.current_subset
+            if not self.current_subset:
                 # catch all
-                rows = self.select_routes("%s AND ServiceCodes = ''" % (postcodequery))
-            if rows:
+                self.current_subset = [row for row in rows if row[4] == '']
+            if self.current_subset:
+                self.service_level = level
                 break
-        if not rows:
+        if not self.current_subset:
             raise ServiceError("No route for service found %r|%r|%r unknown" % \
                 (parcel.country, parcel.postcode, parcel.service))
+        self.service_subset = self.current_subset
 
     def select_depot(self, parcel):
-        """Select all routes with the given depot."""
-        subset = "route IN (%s)" % ','.join([unicode(route) for route in self.current_subset])
-        cur = self.db.cursor()
-        cur.execute("SELECT route FROM routedepots WHERE depot=%s AND %s" % (self.route_data.routingdepot,
-                                                                             subset))
-        rows = cur.fetchall()
-        if not rows:
-            cur.execute("SELECT route FROM routedepots WHERE %s" % (subset))
-            rows = cur.fetchall()
-        if not rows:
-            raise RoutingDepotError("No route found for %r|%r|%r|%r|%r" % \
-                  (parcel.country, parcel.postcode, parcel.service, self.route_data.routingdepot, subset))
-        self.current_subset = [unicode(row[0]) for row in rows]
+        """Select all routes usable from the routing depot."""
+        self.current_subset = [row for row in self.current_subset if row[5] in self.usable_routingplaces]
+        if not self.current_subset:
+            raise RoutingDepotError("No route found for %r|%r|%r|%r" % \
+                  (parcel.country, parcel.postcode, parcel.service, self.routingdepot))
+
+
+class RouteTable(object):
+    """Precomputed routes for all postcodes of a country and a service sent from a routing depot.
 
+    Only countries with purely numeric postcodes of fixed length are supported. routes is a list of
+    distinct Routes without postcode, indexes an array giving for every postcode as integer the position
+    of its route in routes. Position 0 means the Router found no route.
+    """
 
-def get_route_without_cache(country=None, postcode=None, city=None, servicecode='101'):
-    router = Router(RouteData())
-    return router.route(Destination(country, postcode, city))
+    def __init__(self, country, service, depot, routes, indexes):
+        self.country = country
+        self.service = service
+        self.depot = depot
+        self.digits = postcode_digits(country)
+        self.routes = routes
+        self.indexes = indexes
+
+    @classmethod
+    def build(cls, router, country, service):
+        """Route one postcode of every postcode interval of country in which the same routes match."""
+        digits = postcode_digits(country)
+        postcodepattern = re.compile(r'(\d{%d})?$' % digits)
+        points = set([0, 10 ** digits])
+        cur = router.db.cursor()
+        cur.execute("SELECT BeginPostCode, EndPostCode FROM routes WHERE DestinationCountry=?", (country, ))
+        for begin, end in cur.fetchall():
+            # the routes table compares postcodes as strings, this only matches integers of equal length
+            if not (postcodepattern.match(begin) and postcodepattern.match(end)):
+                raise InvalidFormatError("can't precompute routes for %s, postcodes %r|%r"
+                                         % (country, begin, end))
+            if begin:
+                # routes starting at a postcode also match it exactly
+                points.update([int(begin), int(begin) + 1])
+            if end:
+                points.add(int(end) + 1)
+        points = sorted(points)
+
+        routes = [None]
+        positions = {}
+        indexes = array.array('H')
+        for start, stop in zip(points, points[1:]):
+            try:
+                route = router.route(Destination(country, '%0*d' % (digits, start), None, service))
+            except GeorouteException:
+                position = 0
+            else:
+                route = route._replace(postcode=u'')
+                position = positions.get(route)
+                if position is None:
+                    position = positions[route] = len(routes)
+                    routes.append(route)
+            indexes.extend([position] * (stop - start))
+        return cls(country, service, router.routingdepot, routes, indexes)
+
+    @classmethod
+    def load(cls, router, country, service):
+        """Return the RouteTable from the routes database of the Router, it is built if missing."""
+        cur = router.db.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS precomputed
+                       (Country TEXT, Service TEXT, Depot TEXT, Routes BLOB, Indexes BLOB,
+                        PRIMARY KEY (Country, Service, Depot))""")
+        cur.execute("SELECT Routes, Indexes FROM precomputed WHERE Country=? AND Service=? AND Depot=?",
+                    (country, service, router.routingdepot))
+        row = cur.fetchone()
+        if row is None:
+            start = time.time()
+            table = cls.build(router, country, service)
+            cur.execute("INSERT OR REPLACE INTO precomputed VALUES (?,?,?,?,?)",
+                        (country, service, router.routingdepot, buffer(table.dump_routes()),
+                         buffer(table.indexes.tostring())))
+            router.db.commit()
+            logging.info("precomputed %d routes to %s for service %s from %s in %.1fs", len(table.routes) - 1,
+                         country, service, router.routingdepot, time.time() - start)
+            return table
+        routes = [None] + [Route.from_bytes(line) for line in str(row[0]).split('\n') if line]
+        indexes = array.array('H')
+        indexes.fromstring(str(row[1]))
+        return cls(country, service, router.routingdepot, routes, indexes)
+
+    def dump_routes(self):
+        """Serialize routes, see Route.to_bytes()."""
+        return '\n'.join([route.to_bytes() for route in self.routes[1:]])
+
+    def lookup(self, postcode):
+        """Return the Route for a normalized postcode, or None if the postcode isn't covered or a Router
+        would raise an exception."""
+        if len(postcode) != self.digits or not postcode.isdigit():
+            return None
+        route = self.routes[self.indexes[int(postcode)]]
+        if route is None:
+            return None
+        return route._replace(postcode=postcode)
+
+
+def postcode_digits(country):
+    """Return the number of digits of the postcodes of country or raise ValueError if they aren't
+    purely numeric."""
+    match = re.match(r'\\d\{(\d+)\}$', FORMATS.get(country, ''))
+    if match is None:
+        raise ValueError("postcodes of %s are not numeric" % country)
+    return int(match.group(1))
+
+
+# countries and services routed by PrecomputedRouter from RouteTables
+PRECOMPUTED_COUNTRIES = ('DE', )
+PRECOMPUTED_SERVICES = ('101', )
+
+
+class PrecomputedRouter(Router):
+    """Router answering parcels to the given countries and services from RouteTables.
+
+    The tables are stored in the routes database, so they are built once for each version of the
+    routing tables. Other parcels, and parcels for which no route exists, are routed by Router.route().
+    """
+
+    def __init__(self, data, routingdepot=None, countries=PRECOMPUTED_COUNTRIES,
+                 services=PRECOMPUTED_SERVICES):
+        Router.__init__(self, data, routingdepot)
+        self.tables = {}
+        for country in countries:
+            for service in services:
+                self.tables[(country, service)] = RouteTable.load(Router(data, self.routingdepot), country,
+                                                                  service)
 
+    def route(self, parcel):
+        """Find route. parcel is not modified."""
+        if parcel.postcode:
+            country, postcode = normalize_postcode(parcel.country, parcel.postcode)
+            table = self.tables.get((country, parcel.service))
+            if table is not None:
+                route = table.lookup(postcode)
+                if route is not None:
+                    stats = self.stats or _stats
+                    if stats is not None:
+                        stats.count('precomputed')
+                    return route
+        return Router.route(self, parcel)
+
+
+# tables read by RouteData, CityIndex reads all LOCATION.* tables as well, see table_names()
+ROUTETABLES = ('COUNTRY', 'DEPOTS', 'LOCATION.DE', 'ROUTES', 'SERVICE', 'SERVICEINFO.DE')
+
+
+def table_names(path):
+    """Return the sorted names of all tables in path read by RouteData."""
+    names = set(ROUTETABLES)
+    for filename in glob.glob(os.path.join(path, 'LOCATION.*')):
+        name = os.path.basename(filename)
+        names.add(name[:-3] if name.endswith('.gz') else name)
+    return sorted(names)
+# routed with new tables before they are used
+SMOKETEST_DESTINATIONS = [('DE', '42897'), ('DE', '53111'), ('AT', '4240'), ('FR', '66400'), ('LI', '8440')]
+
+
+class RouteDataManager(object):
+    """Keeps the current RouteData of a process and replaces it by new tables without downtime.
+
+    reload() validates and builds new tables, by default in a background thread, and then swaps them in.
+    router() always returns a Router working on the current tables. Routers handed out before a swap
+    keep working on the old tables, so requests in flight are not disturbed.
+
+    If enforce_expiration is set, router() and reload() raise TableExpiredError for tables past the
+    #Expiration: date in their header.
+
+    router_class is used to create Routers. With PrecomputedRouter the RouteTables of new tables are
+    built by reload() before the tables are swapped in.
+    """
+
+    def __init__(self, path=ROUTETABLES_BASE, routingdepot='0142', enforce_expiration=True,
+                 smoketest=SMOKETEST_DESTINATIONS, router_class=Router):
+        self.path = path
+        self.router_class = router_class
+        self.routingdepot = routingdepot
+        self.enforce_expiration = enforce_expiration
+        self.smoketest = smoketest
+        self.data = None
+        self.previous = None
+        self.reload_error = None
+        self.lock = threading.Lock()
+        # Routers keep state while routing, so every thread gets its own
+        self.local = threading.local()
+
+    @property
+    def version(self):
+        """Version of the current tables."""
+        if self.data is not None:
+            return self.data.version
+        return read_header(os.path.join(self.path, 'SERVICE')).get('Version')
+
+    def validate(self, path):
+        """Check version and hash of all tables in path, return the version."""
+        versions = set()
+        for name in table_names(path):
+            filename = os.path.join(path, name)
+            header = read_header(filename)
+            if 'Version' not in header or 'Hash' not in header:
+                raise InvalidFormatError("%s has no version or hash" % filename)
+            if table_hash(filename) != header['Hash']:
+                raise InvalidFormatError("%s doesn't match its hash" % filename)
+            versions.add(header['Version'])
+        if len(versions) != 1:
+            raise InvalidFormatError("tables in %s have different versions: %s" % (path, sorted(versions)))
+        return versions.pop()
+
+    def load(self, path):
+        """Validate the tables in path, build a RouteData object and smoke test it.
+
+        Routes which didn't change since the current tables are taken from their database. If no other
+        table changed, cached routes not affected by the diff stay valid, see unchanged_since(). The
+        database built for the tables is removed again if they fail the smoke test.
+        """
+        version = self.validate(path)
+        dbname = ROUTES_DB_BASE + ('-%s.db' % version)
+        existed = os.path.exists(dbname)
+        data = None
+        try:
+            diff = import_routes(self.path, path)
+            data = RouteData(self.routingdepot, path)
+            data.routes_diff = diff
+            if diff is not None and table_names(self.path) == table_names(path):
+                for name in table_names(path):
+                    if name != 'ROUTES' and (read_header(os.path.join(self.path, name)).get('Hash')
+                                             != read_header(os.path.join(path, name)).get('Hash')):
+                        break
+                else:
+                    data.diff_version = read_header(os.path.join(self.path, 'SERVICE')).get('Version')
+            if self.enforce_expiration and data.expired():
+                raise TableExpiredError("tables %s expired at %s" % (data.version, data.expiration))
+            router = self.router_class(data)
+            for destination in self.smoketest:
+                router.route(Destination(*destination))
+        except Exception:
+            if data is not None:
+                data.db.close()
+            if not existed and os.path.exists(dbname):
+                os.remove(dbname)
+            raise
+        return data
+
+    def swap(self, data):
+        """Make data the current RouteData, the old one is kept as previous."""
+        with self.lock:
+            self.previous, self.data = self.data, data
+
+    def reload(self, path=None, background=True):
+        """Load the tables in path (by default the current path) and swap them in if they are valid.
+
+        With background set the tables are loaded in a new thread which is returned. If loading fails the
+        exception is logged and kept in reload_error, otherwise it is raised.
+        """
+        path = path or self.path
+
+        def run():
+            try:
+                data = self.load(path)
+            except Exception, exception:
+                logging.exception("loading routing tables from %s failed", path)
+                self.reload_error = exception
+                return
+            self.reload_error = None
+            self.swap(data)
+            self.path = path
+            logging.info("switched to routing tables %s", data.version)
+
+        if not background:
+            run()
+            if self.reload_error is not None:
+                raise self.reload_error
+            return None
+        thread = threading.Thread(target=run, name='georoute-reload')
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def unchanged_since(self, country, postcode):
+        """Return the version of the previous tables if routes to the normalized country and postcode
+        are the same with the current tables, None if they might have changed.
+
+        Caches keyed by the version use this to keep the routes not affected by a table update.
+        """
+        data = self.data
+        if data is None or data.diff_version is None or not postcode:
+            return None
+        if data.routes_diff.affects(country, postcode):
+            return None
+        return data.diff_version
 
-def get_route(country=None, postcode=None, city=None, servicecode='101'):
+    def router(self, depot=None):
+        """Return a Router for parcels sent from depot working on the current tables."""
+        data = self.data
+        if data is None:
+            with self.lock:
+                if self.data is None:
+                    self.data = RouteData(self.routingdepot, self.path)
+                data = self.data
+        if self.enforce_expiration and data.expired():
+            raise TableExpiredError("tables %s expired at %s" % (data.version, data.expiration))
+        depot = depot or self.routingdepot
+        routers = getattr(self.local, 'routers', None)
+        if routers is None:
+            routers = self.local.routers = {}
+        router = routers.get(depot)
+        if router is None or router.route_data is not data:
+            router = routers[depot] = self.router_class(data, depot)
+        return router
+
+
+# get_route() has never checked the expiration date and the tables shipped with pyShipping might be old
+_manager = RouteDataManager(enforce_expiration=False)
+
+
+def get_manager():
+    """Return the RouteDataManager used by get_router() and get_route()."""
+    return _manager
+
+
+def get_router(depot='0142'):
+    """Return a Router for parcels sent from depot. All these Routers share the current RouteData."""
+    return _manager.router(depot)
+
+
+def get_route_without_cache(country=None, postcode=None, city=None, servicecode='101', depot='0142'):
+    return get_router(depot).route(Destination(country, postcode, city, servicecode))
+
+
+def get_route(country=None, postcode=None, city=None, servicecode='101', depot='0142'):
     # this includes somewhat overly complex caching
+    country, postcode = normalize_postcode(country, postcode)
+    # the version is part of the key, so cached routes of old tables are only used if they didn't change
+    cachekey = "%s_%s_%s_%s_%s" % (country, postcode, servicecode, depot, _manager.version)
     filename = ROUTES_DB_BASE + ('_cache.db')
     cache_db = sqlite3.connect(filename, isolation_level=None)
     cur = cache_db.cursor()
-    # ensure table exists
-    cur.execute("""SELECT COUNT(*)
-                 FROM sqlite_master
-                 WHERE type = 'table' AND name = 'routing_cache'""")
-    if not cur.fetchone()[0]:
-        logging.info("regenerating cache table")
-        cur.execute("""CREATE TABLE routing_cache
-        (country_postcode_servicecode TEXT PRIMARY KEY,
-        d_depot TEXT,
-        o_sort TEXT,
-        d_sort TEXT,
-        grouping_priority TEXT,
-        barcode_id TEXT,
-        iata_code TEXT,
-        service_text TEXT,
-        service_mark TEXT,
-        country TEXT,
-        serviceinfo TEXT,
-        countrynum TEXT,
-        routingtable_version TEXT,
-        postcode TEXT
-        )""")
+    # routes are stored serialized by Route.to_bytes(), the old routing_cache table is not used anymore
+    cur.execute("CREATE TABLE IF NOT EXISTS routes_cache (cachekey TEXT PRIMARY KEY, route BLOB)")
 
     # check if entry is cached
-    cur.execute("SELECT * FROM routing_cache WHERE country_postcode_servicecode='%s'"
-                 % ("%s_%s_%s" % (country, postcode, servicecode)))
-    rows = cur.fetchall()
-    if not rows:
+    cur.execute("SELECT route FROM routes_cache WHERE cachekey=?", (cachekey, ))
+    row = cur.fetchone()
+    reused = False
+    if row is None:
+        oldversion = _manager.unchanged_since(country, postcode)
+        if oldversion is not None:
+            cur.execute("SELECT route FROM routes_cache WHERE cachekey=?",
+                        ("%s_%s_%s_%s_%s" % (country, postcode, servicecode, depot, oldversion), ))
+            row = cur.fetchone()
+            reused = row is not None
+    if _stats is not None:
+        _stats.count('cache', row is None and 'miss' or 'hit')
+    if reused:
+        route = Route.from_bytes(str(row[0]))._replace(routingtable_version=_manager.version)
+        cur.execute("INSERT INTO routes_cache VALUES (?, ?)", (cachekey, buffer(route.to_bytes())))
+    elif row is None:
         # nothing found
-        route = get_route_without_cache(country, postcode, city, servicecode)
-        cur.execute("""INSERT INTO routing_cache
-                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                             ("%s_%s_%s" % (country, postcode, servicecode),
-                             route.d_depot,
-                             route.o_sort,
-                             route.d_sort,
-                             route.grouping_priority,
-                             route.barcode_id,
-                             route.iata_code,
-                             route.service_text,
-                             route.service_mark,
-                             route.country,
-                             route.serviceinfo,
-                             route.countrynum,
-                             route.routingtable_version,
-                             route.postcode))
+        route = get_route_without_cache(country, postcode, city, servicecode, depot)
+        cur.execute("INSERT INTO routes_cache VALUES (?, ?)", (cachekey, buffer(route.to_bytes())))
         # For some reason closing the cache generated occasionally runtime errors.
         # cache_db.close()
     else:
-        if len(rows) > 1:
-            raise RuntimeError("to many cache hits!")
-        route = Route(*rows[0][1:])
+        route = Route.from_bytes(str(row[0]))
     return route
 
 
@@ -615,6 +1492,4 @@ def find_route(depot, servicecode, land, plz):
     warnings.warn("georoute.find_route() is deprecated use get_route() instead",
                   DeprecationWarning, stacklevel=2)
 
-    if unicode(depot) != '0142':
-        raise RuntimeError("wrong depot")
-    return get_route(unicode(land), unicode(plz), servicecode=unicode(servicecode))
+    return get_route(unicode(land), unicode(plz), servicecode=unicode(servicecode), depot="%04d" % int(depot))
@@ -3,11 +3,29 @@
 
 """Test routing resolver for DPD. Coded by jmv, extended by md"""
 
+import gzip
+import hashlib
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
 import time
 import unittest
+from pyshipping.carriers.dpd import georoute
 from pyshipping.carriers.dpd.georoute import get_route, get_route_without_cache
-from pyshipping.carriers.dpd.georoute import RouteData, Router, Destination
-from pyshipping.carriers.dpd.georoute import ServiceError, CountryError, TranslationError
+from pyshipping.carriers.dpd.georoute import RouteData, Router, Destination, Route
+from pyshipping.carriers.dpd.georoute import ServiceError, CountryError, TranslationError, DepotError
+from pyshipping.carriers.dpd.georoute import InvalidFormatError, get_router
+from pyshipping.carriers.dpd.georoute import GeorouteException
+from pyshipping.carriers.dpd.georoute import RouteDataManager, TableExpiredError, ROUTETABLES_BASE
+from pyshipping.carriers.dpd.georoute import read_header, table_hash, diff_routes, import_routes
+from pyshipping.carriers.dpd.georoute import ROUTES_DB_BASE, table_names
+from pyshipping.carriers.dpd.georoute import normalize_postcode, fold_city, CityIndex
+from pyshipping.carriers.dpd.georoute import RouteStats, enable_stats, disable_stats, get_stats
+from pyshipping.carriers.dpd.georoute import PrecomputedRouter, postcode_digits
+from pyshipping.carriers.dpd.georoute import _COUNTRY_QUERY, _POSTCODE_QUERIES
+from pyshipping.carriers.dpd.georoute import _readfile, _table_blocks
 
 
 class TestCase(unittest.TestCase):
@@ -55,18 +73,41 @@ class RouteDataTest(TestCase):
                           u'+49-(0) 23 03-8 88-0', u'+49-(0) 23 03-8 88-31', u'', u''),
                          rows[0])
 
-    def test_expand_depots(self):
+    def test_routingplaces_match(self):
+        self.assert_(self.data.routingplaces_match('', '0142'))
+        self.assert_(self.data.routingplaces_match('CBE,CDE', '0142'))
+        self.assert_(self.data.routingplaces_match('D01380139,D0142', '0142'))
+        self.assert_(self.data.routingplaces_match('D01380149', '0142'))
+        self.assert_(not self.data.routingplaces_match('CAT,D01380139,GCHRF', '0142'))
+        self.assert_(self.data.routingplaces_match('CAT,D01380139,GCHRF', '0401'))
+        self.assertRaises(InvalidFormatError, self.data.routingplaces_match, 'X0142', '0142')
+        self.assertRaises(DepotError, self.data.routingplaces_match, 'CDE', '9999')
+
+    def test_usable_routes(self):
         c = self.db.cursor()
-        c.execute("""SELECT id
-                     FROM routes
-                     WHERE DestinationCountry='DE' AND BeginPostCode='42477'""")
-        rows = c.fetchall()
-        # Interestingly we sometimes get two routes
-        # self.assertEqual(1, len(rows))
-        route = rows[0][0]
-        c.execute("SELECT depot FROM routedepots WHERE route=?", (route, ))
-        rows = c.fetchall()
-        self.assertEqual(1, len(rows))
+        c.execute("SELECT COUNT(*) FROM routingplaces")
+        self.assert_(c.fetchone()[0] < 100)
+        usable, total = self.data.count_routes('0142')
+        self.assert_(0 < usable < total)
+        self.assertNotEqual(self.data.usable_routingplaces('0142'), self.data.usable_routingplaces('0401'))
+
+    def test_no_location_table(self):
+        # cities are looked up in CityIndex, the database only holds depots and routes
+        c = self.db.cursor()
+        c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='location'")
+        self.assertEqual(0, c.fetchone()[0])
+
+    def test_query_plan(self):
+        # all routing queries have to be answered using an index
+        params = {'country': 'DE', 'postcode': '42897'}
+        queries = [(_COUNTRY_QUERY, ('DE', ))] + [(query, params) for query in _POSTCODE_QUERIES]
+        for query, queryparams in queries:
+            c = self.db.cursor()
+            c.execute('EXPLAIN QUERY PLAN ' + query, queryparams)
+            for row in c.fetchall():
+                detail = row[-1]
+                self.assert_('SCAN' not in detail, (query, detail))
+                self.assert_('routes_country_postcodes' in detail or 'PRIMARY KEY' in detail, (query, detail))
 
     def test_get_service(self):
         self.assertEqual(self.data.get_service('180'), ('180', 'AM1-NO', '', '022,160', ''))
@@ -79,6 +120,45 @@ class RouteDataTest(TestCase):
     def test_translate_location(self):
         self.assertEqual('1', self.data.translate_location('Dublin', 'IE'))
         self.assertRaises(TranslationError, self.data.translate_location, 'Cahir', 'IE')
+        self.assertEqual('1', self.data.translate_location(u'DUBLIN ', 'ie'))
+        self.assertEqual('2', self.data.translate_location("Reste de l'Irlande (sauf Dublin)", 'IE'))
+        # misspelled cities are only suggested, see locate()
+        self.assertRaises(TranslationError, self.data.translate_location, 'Dublni', 'IE')
+
+    def test_translate_similar_cities(self):
+        path = tempfile.mkdtemp()
+        try:
+            open(os.path.join(path, 'LOCATION.DE'), 'w').write('|Neustadt a. d. Aisch|DE|91413|\n'
+                                                               '|Neustadt a. d. Waldnaab|DE|92660|\n'
+                                                               '|Remscheid|DE|42897|\n')
+            cities = CityIndex(path)
+            self.assertEqual(cities.translate('Neustadt a.d. Aisch', 'DE'), '91413')
+            self.assertEqual(cities.translate('Remscheidt', 'DE'), '42897')
+            # near misses between two towns
+            self.assertRaises(TranslationError, cities.translate, 'Neustadt', 'DE')
+            self.assertRaises(TranslationError, cities.translate, 'Neustadt a. d. Aischnaab', 'DE')
+            self.assertRaises(TranslationError, cities.translate, 'Remschied', 'DE')
+            self.assertEqual([postcode for score, postcode, city in cities.lookup('Neustadt', 'DE')],
+                             ['91413', '92660'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_locate(self):
+        self.assertEqual(self.data.locate('Dublin', 'IE'), [(1.0, '1', 'Dublin')])
+        candidates = self.data.locate('Dublni', 'IE')
+        self.assertEqual([postcode for score, postcode, city in candidates], ['1'])
+        self.assert_(0.4 <= candidates[0][0] < 1.0)
+        candidates = self.data.locate('Irland ohne Dublin', 'IE')
+        self.assertEqual(candidates[0], (1.0, '2', 'Irland ohne Dublin'))
+        self.assertEqual(self.data.locate('Ireland without Dublin', 'IE')[0][1], '2')
+        self.assertEqual(self.data.locate('Dublin', 'DE'), [])
+        self.assertEqual(self.data.locate(None, 'IE'), [])
+
+    def test_fold_city(self):
+        self.assertEqual(fold_city(u'D\xfcsseldorf'), u'duesseldorf')
+        self.assertEqual(fold_city('D\xc3\xbcsseldorf'), u'duesseldorf')
+        self.assertEqual(fold_city(u' Saint-\xc9tienne '), u'saint etienne')
+        self.assertEqual(fold_city(u'STRA\xdfE'), u'strasse')
 
 
 class RouterTest(TestCase):
@@ -272,7 +352,8 @@ class RouterTest(TestCase):
             'service_text': u'D'})
         # BG   | 1766 | Sofia
         self.assertDicEq(get_route('BG', '1766').routingdata(),
-            {'d_depot': u'1660', 'serviceinfo': '', 'country': u'BG', 'd_sort': u'', 'o_sort': u'62', 'service_text': u'D'})
+            {'d_depot': u'1660', 'serviceinfo': '', 'country': u'BG', 'd_sort': u'', 'o_sort': u'62',
+            'service_text': u'D'})
         # CH   | 3601 | Thun/Schweiz
         self.assertDicEq(get_route('CH', '3601').routingdata(),
             {'d_depot': u'0612', 'serviceinfo': u'', 'country': u'CH', 'd_sort': u'', 'o_sort': u'78',
@@ -443,6 +524,23 @@ class RouterTest(TestCase):
     def test_cache(self):
         self.assertDicEq(vars(get_route('LI', '8440')), vars(get_route_without_cache('LI', '8440')))
 
+    def test_route_by_city(self):
+        route = self.router.route(Destination('IE', None, 'dublin'))
+        self.assertEqual(route.postcode, '1')
+
+    def test_other_depots(self):
+        # some routes are only used from the depots listed in their RoutingPlaces
+        router = Router(self.data, '0138')
+        self.assertEqual(router.route(Destination('FR', '90000')).d_depot, '1068')
+        self.assertEqual(self.router.route(Destination('FR', '90000')).d_depot, '0434')
+        self.assert_(get_router('0138').route_data is get_router('0142').route_data)
+        self.assertRaises(DepotError, Router, self.data, '9999')
+
+    def test_destination_not_modified(self):
+        destination = Destination('de', 'D-42897')
+        self.assertEqual(self.router.route(destination).postcode, '42897')
+        self.assertEqual((destination.country, destination.postcode), ('de', 'D-42897'))
+
 
 class HighLevelTest(TestCase):
 
@@ -481,6 +579,409 @@ class HighLevelTest(TestCase):
     def test_cache(self):
         self.assertEqual(vars(get_route('LI', '8440')), vars(get_route_without_cache('LI', '8440')))
 
+    def test_normalized_cache_key(self):
+        self.assertEqual(normalize_postcode('de', 'D-42897'), ('DE', '42897'))
+        self.assertEqual(normalize_postcode('DE', ' 42897 '), ('DE', '42897'))
+        self.assertEqual(vars(get_route('DE', 'D-42897')), vars(get_route('DE', '42897')))
+
+
+class RouteTest(TestCase):
+
+    def setUp(self):
+        self.route = get_route_without_cache('DE', '42897')
+
+    def test_fields(self):
+        self.assertEqual(self.route.d_depot, '0142')
+        self.assertEqual(vars(self.route)['d_depot'], '0142')
+        self.assertEqual(list(vars(self.route)), list(Route._fields))
+        self.assertEqual(self.route.routingdata()['d_depot'], '0142')
+        self.assert_(u'D-Depot: 0142' in unicode(self.route))
+
+    def test_immutable(self):
+        self.assertRaises(AttributeError, setattr, self.route, 'd_depot', '0143')
+        self.assertRaises(AttributeError, setattr, self.route, 'other', '0143')
+        self.assertEqual(self.route._replace(d_depot='0143').d_depot, '0143')
+
+    def test_serialization(self):
+        for route in [self.route, get_route_without_cache('IE', None, 'Dublin'),
+                      Route(*([u'Jägerwald'] * 13))]:
+            self.assertEqual(Route.from_bytes(route.to_bytes()), route)
+            self.assertEqual(Route.from_json(route.to_json()), route)
+            self.assertEqual(pickle.loads(pickle.dumps(route, 2)), route)
+        self.assertEqual(get_route('DE', '42897'), self.route)
+        self.assertEqual(get_route('DE', '42897'), self.route)
+
+
+class RouteStatsTest(TestCase):
+
+    def setUp(self):
+        self.router = Router(RouteData())
+        self.router.stats = RouteStats()
+
+    def tearDown(self):
+        disable_stats()
+
+    def test_counters(self):
+        for destination in [('DE', '42897'), ('DE', '42480'), ('AD', '500'), ('IE', None, 'Dublin'),
+                            ('DE', '42897', None, '350')]:
+            self.router.route(Destination(*destination))
+        self.assertRaises(CountryError, self.router.route, Destination('XX', '12345'))
+        stats = self.router.stats.as_dict()
+        self.assertEqual(stats['routes'], 5)
+        self.assertEqual(stats['postcode_exact'], 3)
+        self.assertEqual(stats['postcode_range'], 1)
+        self.assertEqual(stats['postcode_country'], 1)
+        # only the route for service 350 lists its service code, the others are for any service
+        self.assertEqual(stats['service_exact'], 1)
+        self.assertEqual(stats['service_any_exact'], 2)
+        self.assertEqual(stats['city_lookups'], 1)
+        self.assertEqual(stats['errors_CountryError'], 1)
+        self.assertEqual(stats['stage_total_count'], 5)
+        self.assertEqual(stats['stage_country_count'], 5)
+        self.assert_(stats['stage_postcode_seconds'] > 0)
+        self.assertEqual(stats['cache_hit_rate'], None)
+        self.assertEqual(get_stats(), None)
+
+    def test_prometheus(self):
+        self.router.route(Destination('DE', '42897'))
+        text = self.router.stats.prometheus()
+        self.assert_('# TYPE georoute_routes_total counter\ngeoroute_routes_total 1\n' in text)
+        self.assert_('georoute_postcode_total{match="exact"} 1\n' in text)
+        self.assert_('georoute_stage_seconds_count{stage="total"} 1\n' in text)
+        self.assertEqual(RouteStats().prometheus(), '\n')
+
+    def test_get_route(self):
+        stats = enable_stats()
+        self.assert_(get_stats() is stats)
+        # the first call might be answered from the cache of earlier runs
+        get_route('LI', '9495')
+        hits = stats.counters.get(('cache', 'hit'), 0)
+        get_route('LI', '9495')
+        self.assertEqual(stats.counters[('cache', 'hit')], hits + 1)
+        self.assert_(stats.cache_hit_rate() >= 0.5)
+        disable_stats()
+        get_route('LI', '9495')
+        self.assertEqual(stats.counters[('cache', 'hit')], hits + 1)
+
+
+class PrecomputedRouterTest(TestCase):
+
+    def setUp(self):
+        self.data = RouteData()
+        self.router = Router(self.data)
+        self.precomputed = PrecomputedRouter(self.data)
+
+    def route_or_error(self, router, destination):
+        try:
+            return router.route(destination)
+        except GeorouteException, exception:
+            return exception.__class__
+
+    def test_same_routes(self):
+        for postcode in range(0, 100000, 89) + [42477, 42897, 53111, 99998, 99999]:
+            destination = Destination('DE', '%05d' % postcode)
+            self.assertEqual(self.route_or_error(self.precomputed, destination),
+                             self.route_or_error(self.router, destination))
+
+    def test_lookup(self):
+        table = self.precomputed.tables[('DE', '101')]
+        self.assertEqual(table.lookup('42897'), self.router.route(Destination('DE', '42897')))
+        self.assertEqual(table.lookup('42897').postcode, '42897')
+        self.assertEqual(table.lookup('4289'), None)
+        self.assertEqual(table.lookup('4289A'), None)
+        self.assertEqual(len(table.indexes), 100000)
+        # other countries and services are routed as usual
+        for destination in [('DE', 'D-42897'), ('AT', '4240'), ('DE', '42897', None, '350'),
+                            ('IE', None, 'Dublin')]:
+            self.assertEqual(self.precomputed.route(Destination(*destination)),
+                             self.router.route(Destination(*destination)))
+        self.assertRaises(CountryError, self.precomputed.route, Destination('XX', '12345'))
+
+    def test_postcode_digits(self):
+        self.assertEqual(postcode_digits('DE'), 5)
+        self.assertEqual(postcode_digits('AT'), 4)
+        self.assertRaises(ValueError, postcode_digits, 'GB')
+        self.assertRaises(ValueError, postcode_digits, 'XX')
+
+    def test_manager(self):
+        manager = RouteDataManager(enforce_expiration=False, router_class=PrecomputedRouter)
+        router = manager.router()
+        self.assert_(isinstance(router, PrecomputedRouter))
+        self.assertEqual(router.route(Destination('DE', '42897')).d_depot, '0142')
+
+
+class RouteDataManagerTest(TestCase):
+
+    def setUp(self):
+        self.manager = RouteDataManager(enforce_expiration=False)
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def copy_tables(self):
+        path = os.path.join(self.tempdir, 'tables')
+        shutil.copytree(ROUTETABLES_BASE, path)
+        return path
+
+    def test_header(self):
+        header = read_header(os.path.join(ROUTETABLES_BASE, 'ROUTES'))
+        self.assertEqual(header['Version'], '20140505')
+        self.assertEqual(header['Expiration'], '20140831')
+        self.assertEqual(header['Hash'], table_hash(os.path.join(ROUTETABLES_BASE, 'ROUTES')))
+        self.assertEqual(self.manager.validate(ROUTETABLES_BASE), '20140505')
+
+    def test_validate(self):
+        path = self.copy_tables()
+        filename = os.path.join(path, 'SERVICE')
+        lines = open(filename).readlines()
+        open(filename, 'w').writelines(lines[:-1])
+        self.assertRaises(InvalidFormatError, self.manager.validate, path)
+        self.assertRaises(InvalidFormatError, self.manager.reload, path, False)
+        # all LOCATION tables are read by CityIndex
+        path = os.path.join(self.tempdir, 'location')
+        shutil.copytree(ROUTETABLES_BASE, path)
+        open(os.path.join(path, 'LOCATION.FR'), 'a').write('|Paris|FR|75001|\n')
+        self.assertRaises(InvalidFormatError, self.manager.validate, path)
+
+    def test_reload(self):
+        router = self.manager.router()
+        data = router.route_data
+        self.manager.reload().join()
+        self.assertEqual(self.manager.reload_error, None)
+        self.assert_(self.manager.router().route_data is not data)
+        self.assert_(self.manager.previous is data)
+        # routers handed out before keep working on the old tables
+        self.assert_(router.route_data is data)
+        self.assertEqual(router.route(Destination('DE', '42897')).d_depot, '0142')
+        self.assertEqual(self.manager.router('0138').routingdepot, '0138')
+
+    def test_smoketest(self):
+        data = self.manager.router().route_data
+        self.manager.smoketest = [('XX', '12345')]
+        self.manager.reload().join()
+        self.assert_(isinstance(self.manager.reload_error, CountryError))
+        self.assert_(self.manager.router().route_data is data)
+        self.assert_(os.path.exists(ROUTES_DB_BASE + '-20140505.db'))
+        # the database of new tables failing the smoke test is removed
+        path = self.copy_tables()
+        write_tables(path, '20140506', [('DE|42897|||||', 'DE|42897|||||B42|0138||RS16|37|')])
+        self.assertRaises(CountryError, self.manager.reload, path, False)
+        self.assert_(not os.path.exists(ROUTES_DB_BASE + '-20140506.db'))
+
+    def test_expiration(self):
+        manager = RouteDataManager()
+        self.assertRaises(TableExpiredError, manager.router)
+        self.assertRaises(TableExpiredError, manager.reload, None, False)
+        data = self.manager.router().route_data
+        self.assert_(data.expired())
+        self.assert_(not data.expired('20140831'))
+
+
+ROUTES_KEY = 'DestinationCountry|BeginPostCode|EndPostCode|ServiceCodes|RoutingPlaces|SendingDate|'
+ROUTES_HEADER = ('#Version: %s\n'
+                 + '#Fields: ' + ROUTES_KEY + 'O-Sort|D-Depot|GroupingPriority|D-Sort|BarcodeID|\n'
+                 + '#Key: ' + ROUTES_KEY + '\n')
+
+
+def write_tables(path, version, changes=()):
+    """Give all tables in path a new version and replace lines starting like the first item of changes by
+    the second one, None deletes the line."""
+    for name in table_names(path):
+        filename = os.path.join(path, name)
+        if os.path.exists(filename + '.gz'):
+            lines = gzip.GzipFile(filename + '.gz').readlines()
+        else:
+            lines = open(filename).readlines()
+        for start, replacement in changes:
+            for i, line in enumerate(lines):
+                if line.startswith(start):
+                    lines[i:i + 1] = replacement and [replacement + '\n'] or []
+                    break
+        sha = hashlib.sha1(''.join([line for line in lines if not line.startswith('#')])).hexdigest()
+        for i, line in enumerate(lines):
+            if line.startswith('#Version:'):
+                lines[i] = '#Version: %s\n' % version
+            elif line.startswith('#Hash:'):
+                lines[i] = '#Hash: %s\n' % sha
+        if os.path.exists(filename + '.gz'):
+            gzip.GzipFile(filename + '.gz', 'w').writelines(lines)
+        else:
+            open(filename, 'w').writelines(lines)
+
+
+class TableReaderTest(TestCase):
+
+    def test_blocks(self):
+        filename = os.path.join(ROUTETABLES_BASE, 'ROUTES')
+        blocks = list(_table_blocks(filename, 10000))
+        self.assert_(len(blocks) > 1)
+        self.assertEqual([block for block in blocks if not block.endswith('\n')], [])
+        self.assertEqual(''.join(blocks), gzip.GzipFile(filename + '.gz').read())
+        filename = os.path.join(ROUTETABLES_BASE, 'SERVICE')
+        self.assertEqual(''.join(_table_blocks(filename, 100)), open(filename).read())
+
+    def test_gzip_members(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'SERVICE')
+            lines = open(os.path.join(ROUTETABLES_BASE, 'SERVICE')).readlines()
+            for blocksize in (10, 100000):
+                gzipped = open(filename + '.gz', 'wb')
+                # three members, the last one empty, and zero padding
+                for part in (lines[:len(lines) // 2], lines[len(lines) // 2:], []):
+                    member = gzip.GzipFile(fileobj=gzipped, mode='wb')
+                    member.writelines(part)
+                    member.close()
+                gzipped.write('\0' * 10)
+                gzipped.close()
+                self.assertEqual(''.join(_table_blocks(filename, blocksize)), ''.join(lines))
+                self.assertEqual(len(list(_readfile(filename))),
+                                 len([line for line in lines if not line.startswith('#')]))
+        finally:
+            shutil.rmtree(path)
+
+    def test_readfile(self):
+        for name in ('ROUTES', 'SERVICE'):
+            filename = os.path.join(ROUTETABLES_BASE, name)
+            if name == 'ROUTES':
+                lines = gzip.GzipFile(filename + '.gz').readlines()
+            else:
+                lines = open(filename).readlines()
+            expected = [line.decode('latin1').strip().split('|')
+                        for line in lines if not line.startswith('#')]
+            self.assertEqual(list(_readfile(filename)), expected)
+
+
+class RoutesDiffTest(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.newdb = ROUTES_DB_BASE + '-20140506.db'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        if os.path.exists(self.newdb):
+            os.remove(self.newdb)
+
+    def write_routes(self, name, lines):
+        filename = os.path.join(self.tempdir, name)
+        open(filename, 'w').write(ROUTES_HEADER % name + '\n'.join(lines) + '\n')
+        return filename
+
+    def test_diff(self):
+        old = self.write_routes('old', ['DE||||||B42|0142|||37|',
+                                        'DE|42897|||||B42|0142||RS15|37|',
+                                        'DE|42477|||||B42|0142||RS07|37|',
+                                        'DE|53111|53119||||B42|0153||10|37|'])
+        new = self.write_routes('new', ['DE||||||B42|0142|||37|',
+                                        'DE|42897|||||B42|0138||RS16|37|',
+                                        'DE|40000|40999||||B42|0140||12|37|',
+                                        'DE|53111|53119||||B42|0153||10|37|'])
+        diff = diff_routes(old, new)
+        self.assertEqual(len(diff), 4)
+        self.assert_(diff.ordered)
+        self.assertEqual([number for number, line in diff.deleted], [1, 2])
+        self.assertEqual([(position, line[1]) for position, line in diff.inserted],
+                         [(1, '42897'), (1, '40000')])
+        self.assertEqual(diff.sort_changes(), [('DE', '42897', '', 'D-Depot', '0142', '0138'),
+                                               ('DE', '42897', '', 'D-Sort', 'RS15', 'RS16')])
+        self.assertEqual(diff.postcodes(), [('DE', '40000', '40999'), ('DE', '42477', ''),
+                                            ('DE', '42897', '')])
+        self.assert_(diff.affects('DE', '42897'))
+        self.assert_(diff.affects('DE', '40100'))
+        self.assert_(not diff.affects('DE', '53111'))
+        self.assert_(not diff.affects('AT', '42897'))
+        self.assertEqual(len(diff_routes(old, old)), 0)
+
+    def test_reordered(self):
+        old = self.write_routes('old', ['DE|42897|||||B42|0142||RS15|37|', 'DE||||||B42|0142|||37|'])
+        new = self.write_routes('new', ['DE||||||B42|0142|||37|', 'DE|42897|||||B42|0142||RS15|37|'])
+        diff = diff_routes(old, new)
+        self.assertEqual(len(diff), 0)
+        self.assert_(not diff.ordered)
+
+    def test_import_routes(self):
+        oldrouter = Router(RouteData())
+        path = os.path.join(self.tempdir, 'tables')
+        shutil.copytree(ROUTETABLES_BASE, path)
+        write_tables(path, '20140506', [('DE|42897|||||', 'DE|42897|||||B42|0138||RS16|37|'),
+                                        ('DE|42477|42482||||', 'DE|42477|42479||||B42|0140||RADE|37|')])
+        manager = RouteDataManager(enforce_expiration=False)
+        manager.reload(path, background=False)
+        data = manager.router().route_data
+        self.assertEqual(data.version, '20140506')
+        self.assertEqual(len(data.routes_diff), 4)
+        self.assertEqual(data.routes_diff.sort_changes()[0], ('DE', '42897', '', 'D-Depot', '0142', '0138'))
+        router = manager.router()
+        self.assertEqual(router.route(Destination('DE', '42897')).d_depot, '0138')
+        self.assertEqual(router.route(Destination('DE', '42477')).d_depot, '0140')
+        for destination in BENCHMARK_DESTINATIONS:
+            destination = Destination(*destination)
+            if not data.routes_diff.affects(*normalize_postcode(destination.country, destination.postcode)):
+                self.assertEqual(router.route(destination).routingdata(),
+                                 oldrouter.route(destination).routingdata())
+        # nothing to import if the database exists
+        self.assertEqual(import_routes(ROUTETABLES_BASE, path), None)
+
+    def test_cache_reuse(self):
+        path = os.path.join(self.tempdir, 'tables')
+        shutil.copytree(ROUTETABLES_BASE, path)
+        write_tables(path, '20140506', [('DE|42897|||||', 'DE|42897|||||B42|0138||RS16|37|')])
+        manager = RouteDataManager(enforce_expiration=False)
+        manager.router()
+        oldroute = manager.router().route(Destination('DE', '53111'))
+        manager.reload(path, background=False)
+        self.assertEqual(manager.unchanged_since('DE', '53111'), '20140505')
+        self.assertEqual(manager.unchanged_since('DE', '42897'), None)
+
+        # cached routes of the previous tables are used if the diff doesn't affect them
+        oldmanager, georoute._manager = georoute._manager, manager
+        cache_db = sqlite3.connect(ROUTES_DB_BASE + '_cache.db', isolation_level=None)
+        keys = ['%s_%s_101_0142_%s' % (country, postcode, version) for country, postcode in
+                [('DE', '53111'), ('DE', '42897')] for version in ('20140505', '20140506')]
+        try:
+            get_route('DE', '40000')  # creates the cache table
+            cache_db.executemany("DELETE FROM routes_cache WHERE cachekey=?", [(key, ) for key in keys])
+            for key in keys[::2]:
+                cache_db.execute("INSERT INTO routes_cache VALUES (?, ?)",
+                                 (key, buffer(oldroute._replace(d_depot='9999').to_bytes())))
+            route = get_route('DE', '53111')
+            self.assertEqual(route.d_depot, '9999')
+            self.assertEqual(route.routingtable_version, '20140506')
+            self.assertEqual(get_route('DE', '42897').d_depot, '0138')
+        finally:
+            georoute._manager = oldmanager
+            cache_db.executemany("DELETE FROM routes_cache WHERE cachekey=?", [(key, ) for key in keys])
+
+        # changes of other tables might change any route
+        newpath = os.path.join(self.tempdir, 'newtables')
+        shutil.copytree(path, newpath)
+        write_tables(newpath, '20140507', [('DE|42897|||||', 'DE|42897|||||B42|0140||RS16|37|'),
+                                           ('101|', '101|D||001,002|')])
+        try:
+            manager.reload(newpath, background=False)
+            self.assert_(manager.router().route_data.routes_diff is not None)
+            self.assertEqual(manager.unchanged_since('DE', '53111'), None)
+        finally:
+            if os.path.exists(ROUTES_DB_BASE + '-20140507.db'):
+                os.remove(ROUTES_DB_BASE + '-20140507.db')
+
+
+BENCHMARK_DESTINATIONS = [('DE', '42477'), ('DE', '53111'), ('DE', 'A-4240'), ('AT', '4240'), ('FR', '66400'),
+                          ('LI', '8440'), ('GB', 'GU14 8HN'), ('PL', '02-222'), ('IE', None, 'Dublin')]
+
+
+def benchmark(router, rounds=100):
+    """Returns the mean time in seconds needed to route a parcel."""
+    destinations = [Destination(*destination) for destination in BENCHMARK_DESTINATIONS]
+    start = time.time()
+    for i in range(rounds):
+        for destination in destinations:
+            router.route(destination)
+    return (time.time() - start) / (rounds * len(destinations))
+
+
 if __name__ == '__main__':
     start = time.time()
     router = Router(RouteData())
@@ -489,5 +990,6 @@ if __name__ == '__main__':
     end = time.time()
     # print ("took %.3fs to find a single route (including %.3fs initialisation overhead)"
     #        % (end-start, stamp-start))
+    print "routing takes %.3f ms per parcel" % (benchmark(router) * 1000)
 
     unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+label.py - data for printing DPD parcel labels
+
+LabelGenerator turns Routes (see georoute) and parcel numbers into everything a label printer needs: the
+barcode with its check character, the human readable barcode text and the formatted sort fields.
+
+The barcode consists of the identifier (the BarcodeID of the route as ASCII code, e.g. 37 for '%'), the
+destination postcode padded to 7 characters, the 14 digit parcel number, the service code and the
+numeric country code. The check character (ISO/IEC 7064 MOD 37,36) is only printed as text.
+
+You might consider this BSD-Licensed.
+"""
+
+import threading
+
+
+# number of (route, service) templates kept by a LabelGenerator
+LABEL_CACHE_SIZE = 10000
+_CHARACTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_VALUES = dict([(character, value) for value, character in enumerate(_CHARACTERS)])
+
+
+def _mod3736(data, product=36):
+    """Run the ISO/IEC 7064 MOD 37,36 recursion over data, starting with product."""
+    for character in data:
+        product = (product + _VALUES[character]) % 36 or 36
+        product = product * 2 % 37
+    return product
+
+
+def check_character(data):
+    """Return the ISO/IEC 7064 MOD 37,36 check character of data (digits and upper case letters).
+
+    >>> check_character('004289701421234567890101276')
+    'F'
+    """
+    return _CHARACTERS[(37 - _mod3736(data)) % 36]
+
+
+class LabelGenerator(object):
+    """Creates label data for parcels.
+
+    Everything depending only on the Route and the service is computed once and kept in a template, so
+    generating labels for many parcels to the same destinations is cheap.
+    """
+
+    def __init__(self, cachesize=LABEL_CACHE_SIZE):
+        self.cachesize = cachesize
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def template(self, route, service='101'):
+        """Return the parts of the label data of route which don't depend on the parcel number."""
+        template = self.templates.get((route, service))
+        if template is None:
+            postcode = (route.postcode or '').upper()
+            if len(postcode) > 7 or [character for character in postcode if character not in _VALUES]:
+                raise ValueError("postcode %r can't be used in the barcode" % route.postcode)
+            postcode = postcode.rjust(7, '0')
+            if len(service) != 3 or not service.isdigit():
+                raise ValueError("invalid service code %r" % service)
+            suffix = service + route.countrynum.rjust(3, '0')
+            sort_text = u' '.join([field for field in (route.o_sort, route.d_depot, route.d_sort) if field])
+            template = {'prefix': chr(int(route.barcode_id)) + postcode,
+                        'postcode': postcode,
+                        'suffix': suffix,
+                        'product': _mod3736(postcode),
+                        'fields': {'d_depot': route.d_depot, 'o_sort': route.o_sort, 'd_sort': route.d_sort,
+                                   'sort_text': sort_text,
+                                   'destination': u'%s-%s' % (route.country, route.postcode or ''),
+                                   'grouping_priority': route.grouping_priority,
+                                   'iata_code': route.iata_code, 'service': service,
+                                   'service_text': route.service_text, 'service_mark': route.service_mark,
+                                   'serviceinfo': route.serviceinfo,
+                                   'routingtable_version': route.routingtable_version}}
+            with self.lock:
+                if len(self.templates) >= self.cachesize:
+                    self.templates.clear()
+                self.templates[(route, service)] = template
+        return template
+
+    def label(self, route, parcelnumber, service='101'):
+        """Return the label data of a parcel as dict.
+
+        parcelnumber has up to 14 digits, the first four are the number of the sending depot.
+        """
+        parcelnumber = str(parcelnumber)
+        if len(parcelnumber) > 14 or not parcelnumber.isdigit():
+            raise ValueError("invalid parcel number %r" % parcelnumber)
+        parcelnumber = parcelnumber.rjust(14, '0')
+        template = self.template(route, service)
+        suffix = template['suffix']
+        check = _CHARACTERS[(37 - _mod3736(parcelnumber + suffix, template['product'])) % 36]
+        label = dict(template['fields'])
+        label['parcelnumber'] = parcelnumber
+        label['parcelnumber_text'] = '%s %s %s %s' % (parcelnumber[:4], parcelnumber[4:8], parcelnumber[8:12],
+                                                     parcelnumber[12:])
+        label['barcode'] = template['prefix'] + parcelnumber + suffix
+        label['check_character'] = check
+        label['barcode_text'] = '%s %s %s %s %s' % (template['postcode'], label['parcelnumber_text'],
+                                                    suffix[:3], suffix[3:], check)
+        return label
+
+    def labels(self, parcels):
+        """Generate label data for many parcels.
+
+        parcels is an iterable of (route, parcelnumber) or (route, parcelnumber, service) tuples.
+        """
+        for parcel in parcels:
+            yield self.label(*parcel)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Test label data generation for DPD."""
+
+import doctest
+import unittest
+from pyshipping.carriers.dpd import label
+from pyshipping.carriers.dpd.georoute import get_route_without_cache
+from pyshipping.carriers.dpd.label import LabelGenerator, check_character
+
+
+class CheckCharacterTest(unittest.TestCase):
+
+    def test_check_character(self):
+        self.assertEqual(check_character('004289701421234567890101276'), 'F')
+        # single changed characters are always detected
+        data = '004289701421234567890101276'
+        for position in range(len(data)):
+            for character in '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+                if character != data[position]:
+                    changed = data[:position] + character + data[position + 1:]
+                    self.assertNotEqual(check_character(changed), 'F')
+
+
+class LabelGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = LabelGenerator()
+        self.route = get_route_without_cache('DE', '42897')
+
+    def test_label(self):
+        data = self.generator.label(self.route, '01421234567890')
+        self.assertEqual(data['barcode'], '%004289701421234567890101276')
+        self.assertEqual(data['check_character'], 'F')
+        self.assertEqual(data['barcode_text'], '0042897 0142 1234 5678 90 101 276 F')
+        self.assertEqual(data['parcelnumber_text'], '0142 1234 5678 90')
+        self.assertEqual(data['sort_text'], 'B42 0142 RS15')
+        self.assertEqual(data['destination'], 'DE-42897')
+        self.assertEqual(data['d_depot'], '0142')
+        self.assertEqual(data['service'], '101')
+
+    def test_foreign(self):
+        route = get_route_without_cache('GB', 'GU14 8HN')
+        data = self.generator.label(route, 1421234567890, '136')
+        self.assertEqual(data['parcelnumber'], '01421234567890')
+        self.assertEqual(data['barcode'], '%GU148HN01421234567890136826')
+        self.assertEqual(data['check_character'], check_character(data['barcode'][1:]))
+        self.assertEqual(data['service'], '136')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.generator.label, self.route, '0142123456789012')
+        self.assertRaises(ValueError, self.generator.label, self.route, '0142-123')
+        self.assertRaises(ValueError, self.generator.label, self.route, '01421234567890', 'D')
+        self.assertRaises(ValueError, self.generator.label, self.route._replace(postcode='AB-1234'), '1')
+
+    def test_templates(self):
+        other = get_route_without_cache('AT', '4240')
+        parcels = [(self.route, '0142%010d' % number) for number in range(100)]
+        parcels += [(other, '0142%010d' % number, '136') for number in range(100)]
+        labels = list(self.generator.labels(parcels))
+        self.assertEqual(len(labels), 200)
+        self.assertEqual(len(self.generator.templates), 2)
+        self.assertEqual([data['check_character'] for data in labels],
+                         [check_character(data['barcode'][1:]) for data in labels])
+        # labels are independent of each other
+        labels[0]['d_depot'] = 'XXXX'
+        self.assertEqual(labels[1]['d_depot'], '0142')
+
+    def test_cachesize(self):
+        generator = LabelGenerator(cachesize=2)
+        for postcode in ('42897', '42477', '42899'):
+            generator.label(self.route._replace(postcode=postcode), 1)
+        self.assertEqual(len(generator.templates), 1)
+
+
+if __name__ == '__main__':
+    doctest.testmod(label)
+    unittest.main()
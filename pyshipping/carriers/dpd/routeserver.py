@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+routeserver.py - DPD routing as a local HTTP/JSON service
+
+Every process using georoute keeps its own RouteData. RouteServer keeps one warm data set (see
+georoute.RouteDataManager) for many worker processes, which use RouteClient instead of get_route().
+
+    GET  /route?country=DE&postcode=42897&service=101&depot=0142
+         {"d_depot": "0142", "o_sort": "B42", ...} or {"error": "NoRouteError", "message": "..."}
+    POST /routes with a JSON list of objects with the same keys
+         a list of routes and errors in the same order
+    GET  /metrics
+         request counters and the version of the routing tables
+
+Identical requests arriving while the route is being looked up wait for that lookup instead of routing
+again. Start the server with `python routeserver.py [port]`.
+
+You might consider this BSD-Licensed.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from pyshipping.carriers.dpd import georoute
+from pyshipping.carriers.dpd.georoute import Destination, GeorouteException, Route
+
+
+DEFAULT_PORT = 8042
+
+
+class Coalescer(object):
+    """Runs a function once for all concurrent calls with the same key."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.coalesced = 0
+
+    def call(self, key, function, *args):
+        """Return function(*args), or the result of a running call with the same key.
+
+        Exceptions are raised in all waiting threads.
+        """
+        with self.lock:
+            call = self.inflight.get(key)
+            if call is None:
+                call = self.inflight[key] = {'done': threading.Event()}
+                owner = True
+            else:
+                self.coalesced += 1
+                owner = False
+        if not owner:
+            call['done'].wait()
+        else:
+            try:
+                call['result'] = function(*args)
+            except Exception, exception:
+                call['exception'] = exception
+            with self.lock:
+                del self.inflight[key]
+            call['done'].set()
+        if 'exception' in call:
+            raise call['exception']
+        return call['result']
+
+
+def _error(exception):
+    return {'error': exception.__class__.__name__, 'message': unicode(exception)}
+
+
+def _text(value):
+    """Values of a request as unicode, JSON clients might send postcodes and depots as numbers."""
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, (list, dict)):
+        raise ValueError("expected a string, not %r" % (value, ))
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+class RouteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server routing parcels with the tables of manager."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', DEFAULT_PORT), manager=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RouteRequestHandler)
+        self.manager = manager or georoute.get_manager()
+        self.coalescer = Coalescer()
+        # all Routers share the SQLite connection of the RouteData, at about 0.1 ms per parcel HTTP
+        # handling takes much longer than routing anyway
+        self.routing_lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'routes': 0, 'errors': 0, 'batches': 0, 'routing_seconds': 0.0}
+        self.counters_lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.counters_lock:
+            self.counters[name] += value
+
+    def _route(self, country, postcode, city, service, depot):
+        with self.routing_lock:
+            start = time.time()
+            try:
+                return vars(self.manager.router(depot).route(Destination(country, postcode, city, service)))
+            finally:
+                self.count('routing_seconds', time.time() - start)
+
+    def route(self, request):
+        """Route a request dict with country, postcode, city, service and depot.
+
+        Returns the Route as dict or an error dict.
+        """
+        self.count('routes')
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("a destination must be an object, not %r" % (request, ))
+            country, postcode = georoute.normalize_postcode(_text(request.get('country')) or 'DE',
+                                                            _text(request.get('postcode')))
+            # the city is only used to find a missing postcode
+            city = postcode is None and _text(request.get('city')) or None
+            service = _text(request.get('service')) or '101'
+            depot = '%04d' % int(_text(request.get('depot')) or self.manager.routingdepot)
+            return self.coalescer.call((country, postcode, city, service, depot), self._route,
+                                       country, postcode, city, service, depot)
+        except (GeorouteException, ValueError), exception:
+            self.count('errors')
+            return _error(exception)
+
+    def metrics(self):
+        """Return counters, uptime and table version as dict."""
+        with self.counters_lock:
+            metrics = dict(self.counters)
+        metrics['coalesced'] = self.coalescer.coalesced
+        metrics['uptime_seconds'] = time.time() - self.started
+        metrics['routingtable_version'] = self.manager.version
+        return metrics
+
+
+class RouteRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles the requests of a RouteServer, see the module documentation."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.count('requests')
+        url = urlparse.urlparse(self.path)
+        if url.path == '/route':
+            query = dict([(key, value.decode('utf-8')) for key, value in urlparse.parse_qsl(url.query)])
+            result = self.server.route(query)
+            self.send_json(result, 'error' in result and 400 or 200)
+        elif url.path == '/metrics':
+            self.send_json(self.server.metrics())
+        else:
+            self.send_json({'error': 'NotFound', 'message': url.path}, 404)
+
+    def do_POST(self):
+        self.server.count('requests')
+        if self.path != '/routes':
+            self.send_json({'error': 'NotFound', 'message': self.path}, 404)
+            return
+        try:
+            requests = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(requests, list):
+                raise ValueError("a list of destinations is expected")
+        except ValueError, exception:
+            self.send_json(_error(exception), 400)
+            return
+        self.server.count('batches')
+        self.send_json([self.server.route(request) for request in requests])
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s", self.address_string(), format % args)
+
+
+def _route_or_error(data):
+    """Convert a route or error dict sent by RouteServer to a Route or a georoute exception."""
+    if 'error' in data:
+        exceptionclass = getattr(georoute, data['error'], None)
+        if not (isinstance(exceptionclass, type) and issubclass(exceptionclass, GeorouteException)):
+            exceptionclass = GeorouteException
+        return exceptionclass(data['message'])
+    return Route._make([data[field] for field in Route._fields])
+
+
+class RouteClient(object):
+    """Routes parcels using a RouteServer."""
+
+    def __init__(self, url='http://127.0.0.1:%d' % DEFAULT_PORT, timeout=10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, body=None):
+        try:
+            response = urllib2.urlopen(self.url + path, body, self.timeout)
+        except urllib2.HTTPError, response:
+            # error responses carry a JSON body as well
+            pass
+        return json.loads(response.read())
+
+    def get_route(self, country=None, postcode=None, city=None, servicecode='101', depot='0142'):
+        """Like georoute.get_route(), raises the same exceptions."""
+        query = {'country': country or '', 'postcode': postcode or '', 'city': city or '',
+                 'service': servicecode, 'depot': depot}
+        query = dict([(key, unicode(value).encode('utf-8')) for key, value in query.items() if value])
+        result = _route_or_error(self._request('/route?' + urllib.urlencode(query)))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def get_routes(self, destinations):
+        """Route many parcels with one request.
+
+        destinations is a sequence of (country, postcode, city, servicecode, depot) tuples, trailing values
+        can be left out. Returns a list with a Route or a georoute exception for each destination.
+        """
+        requests = [dict(zip(('country', 'postcode', 'city', 'service', 'depot'), destination))
+                    for destination in destinations]
+        return [_route_or_error(result) for result in self._request('/routes', json.dumps(requests))]
+
+    def metrics(self):
+        """Return the metrics of the server as dict."""
+        return self._request('/metrics')
+
+
+def serve(port=DEFAULT_PORT, host='127.0.0.1'):
+    """Load the routing tables and serve requests until interrupted."""
+    server = RouteServer((host, port))
+    server.manager.router()
+    logging.info("routing with tables %s on %s:%d", server.manager.version, host, port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    serve(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Test the DPD routing server."""
+
+import json
+import threading
+import unittest
+import urllib2
+from pyshipping.carriers.dpd.georoute import get_route_without_cache, CountryError, ServiceError
+from pyshipping.carriers.dpd.georoute import GeorouteException, Route
+from pyshipping.carriers.dpd.routeserver import RouteServer, RouteClient, Coalescer
+
+
+class RouteServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RouteServer(('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = RouteClient('http://127.0.0.1:%d/' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_route(self):
+        for destination in [('DE', '42897'), ('DE', 'D-42477'), ('AT', '4240'), ('GB', 'GU14 8HN'),
+                            ('IE', None, 'Dublin')]:
+            self.assertEqual(vars(self.client.get_route(*destination)),
+                             vars(get_route_without_cache(*destination)))
+        self.assertEqual(vars(self.client.get_route('FR', '90000', depot='0138')),
+                         vars(get_route_without_cache('FR', '90000', depot='0138')))
+        self.assertEqual(self.client.get_route('FR', '90000', depot='138').d_depot, '1068')
+
+    def test_errors(self):
+        self.assertRaises(CountryError, self.client.get_route, 'XX', '12345')
+        self.assertRaises(ServiceError, self.client.get_route, 'GB', 'XX')
+        self.assertRaises(GeorouteException, self.client.get_route, 'DE', '42897', depot='xxx')
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen, self.client.url + '/nothing')
+
+    def test_batch(self):
+        routes = self.client.get_routes([('DE', '42897'), ('XX', '12345'),
+                                         ('AT', '4240', None, '101', '0138')])
+        self.assertEqual(len(routes), 3)
+        self.assert_(isinstance(routes[0], Route))
+        self.assertEqual(routes[0].d_depot, '0142')
+        self.assert_(isinstance(routes[1], CountryError))
+        self.assertEqual(vars(routes[2]), vars(get_route_without_cache('AT', '4240', depot='0138')))
+
+    def test_batch_invalid(self):
+        requests = [['DE', '42897'], 'DE', {'country': 'DE', 'postcode': 42897, 'depot': 142},
+                    {'postcode': ['42897']}]
+        routes = self.client._request('/routes', json.dumps(requests))
+        self.assertEqual([route.get('error') for route in routes],
+                         ['ValueError', 'ValueError', None, 'ValueError'])
+        self.assertEqual(routes[2]['d_depot'], '0142')
+        self.assertEqual(vars(self.client.get_routes([('AT', 4240)])[0]),
+                         vars(get_route_without_cache('AT', '4240')))
+
+    def test_metrics(self):
+        self.client.get_route('DE', '42897')
+        self.client.get_routes([('DE', '42897'), ('XX', '12345')])
+        metrics = self.client.metrics()
+        self.assertEqual(metrics['requests'], 3)
+        self.assertEqual(metrics['routes'], 3)
+        self.assertEqual(metrics['batches'], 1)
+        self.assertEqual(metrics['errors'], 1)
+        self.assertEqual(metrics['routingtable_version'], self.server.manager.version)
+        self.assert_(metrics['routing_seconds'] > 0)
+
+
+class CoalescerTest(unittest.TestCase):
+
+    def test_coalescing(self):
+        coalescer = Coalescer()
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+        results = []
+
+        def work(value):
+            calls.append(value)
+            started.set()
+            finish.wait()
+            return value * 2
+
+        threads = [threading.Thread(target=lambda: results.append(coalescer.call('key', work, 21)))]
+        threads[0].start()
+        started.wait()
+        for i in range(4):
+            threads.append(threading.Thread(target=lambda: results.append(coalescer.call('key', work, 21))))
+            threads[-1].start()
+        while coalescer.coalesced < 4:
+            threading.Event().wait(0.01)
+        finish.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 5)
+        # later calls run the function again
+        self.assertEqual(coalescer.call('key', work, 1), 2)
+        self.assertEqual(calls, [21, 1])
+
+    def test_exception(self):
+        coalescer = Coalescer()
+        self.assertRaises(CountryError, coalescer.call, 'key', get_route_without_cache, 'XX', '12345')
+        self.assertEqual(coalescer.inflight, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -365,6 +365,17 @@ def _clip(length, data):
 # Zusatztext 1 muss 62 005 - 066
 # Zusatztext 2 kann 62 067 - 128
 
+def _europaletten(lieferung):
+    """Number of euro pallets for a Lieferung.
+
+    Uses shipment.AbstractLieferung.europaletten if available and falls back to one pallet per packstueck.
+    """
+    europaletten = getattr(lieferung, 'europaletten', None)
+    if europaletten is None:
+        return len(lieferung.packstuecke)
+    return europaletten
+
+
 class Bordero(object):
     """Kapselt die Daten für ein Gefäß (LKW) - Verwendung ähnlich IFTSTAR."""
 
@@ -568,7 +579,7 @@ class Bordero(object):
             'kostenzoll': 0,
             'eust': 0,
             'gitterboxen': 0,
-            'europaletten': sum([len(lieferung.packstuecke) for lieferung in self.lieferungen]),
+            'europaletten': sum([_europaletten(lieferung) for lieferung in self.lieferungen]),
             'packstuecke': sum([len(lieferung.packstuecke) for lieferung in self.lieferungen]),
             'sonstigeladehilfsmittel': 0,
             'foo': '',
@@ -3,6 +3,14 @@
 """
 stat.py - parse Fortras STAT messages.
 
+Statusmeldung.records() reads a STAT message from a file object line by line and yields a StatusRecord for
+each Q record. What happens to the records is up to a sink, any callable taking a StatusRecord:
+list.append collects them in memory, BatchWriter hands them on in lists and Statusmeldung.update_record
+(the default) updates huLOG by calling update_sendung().
+
+    stat = Statusmeldung()
+    stat.process(open('STAT.txt'), BatchWriter(save_records))
+
 Created by Maximillian Dornseif on 2006-11-19.
 You may consider this BSD licensed.
 """
@@ -10,6 +18,47 @@ You may consider this BSD licensed.
 import re
 import datetime
 import logging
+from StringIO import StringIO
+from collections import namedtuple
+
+
+STAT_HEADER = '@@PHSTAT128 0128003500107 MAEULER HUDORA1                       '
+# number of records BatchWriter hands on at once
+STAT_BATCHSIZE = 1000
+
+
+class StatusRecord(namedtuple('StatusRecord', 'idbeimempfangspartner verkehrsart sendungsnrversender '
+                                              'sendungsnrempfaenger sendungsschluessel date time wartezeit '
+                                              'quittungsgeber zusatztext timestamp statustext')):
+    """A Q record of a STAT message.
+
+    All fields are stripped strings, except sendungsnrversender (the huLOG Sendung id, int), timestamp
+    (datetime) and statustext (None for unknown status codes).
+    """
+
+    __slots__ = ()
+
+
+class BatchWriter(object):
+    """Sink collecting StatusRecords and calling write() with a list of up to batchsize of them.
+
+    Call flush() after the last record, Statusmeldung.process() does that for you.
+    """
+
+    def __init__(self, write, batchsize=STAT_BATCHSIZE):
+        self.write = write
+        self.batchsize = batchsize
+        self.batch = []
+
+    def __call__(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            batch, self.batch = self.batch, []
+            self.write(batch)
 
 
 class Statusmeldung(object):
@@ -18,6 +67,7 @@ class Statusmeldung(object):
                    + r'(?P<sendungsnrempfaenger>.{16})(?P<sendungsschluessel>[0-9 ]{3})(?P<date>[0-9 ]{8})'
                    + r'(?P<time>[0-9 ]{4})(?P<wartezeit>[0-9 ]{3})(?P<quittungsgeber>.{15})(?P<zusatztext>.{49})'
                    + r'(?P<foo>.)5')
+    q_record_re = re.compile(q_record_re)
     # Satzart ‘Q’ muss 1 001 - 001
     # Identifkations-Nr. des Versandpartners beim Empfangspartner** muss          10 002 - 011
     # Verkehrsart muss 1 012 - 012
@@ -175,38 +225,70 @@ class Statusmeldung(object):
                                                                            datadict['zusatztext']))
         sendung.save()
 
-    def parse(self, data):
-        """Parses Fortras STAT data."""
-        lines = data.split('\n')
-        lines = [x.strip('\r') for x in lines]
-        if lines[0] == '' and len(lines) == 1:
+    def record(self, line):
+        """Converts a Q record line to a StatusRecord, returns None for invalid lines."""
+        match = Statusmeldung.q_record_re.match(line)
+        if not match:
+            logging.error('no match for STAT record %r - ignoring' % line)
+            return None
+        fields = dict([(key, value.strip()) for key, value in match.groupdict().items()])
+        date, time = fields['date'], fields['time']
+        try:
+            if time:
+                fields['timestamp'] = datetime.datetime(int(date[4:]), int(date[2:4]), int(date[:2]),
+                                                        int(time[:2]), int(time[2:]))
+            else:
+                fields['timestamp'] = datetime.datetime(int(date[4:]), int(date[2:4]), int(date[:2]))
+        except ValueError:
+            logging.error("malformed timestamp %r|%r" % (date, time))
+            fields['timestamp'] = datetime.datetime.now()
+        if not fields['sendungsschluessel'].isdigit():
+            logging.error('missing status for STAT record %r - ignoring' % line)
+            return None
+        fields['statustext'] = Statusmeldung.statustexte.get(int(fields['sendungsschluessel']))
+        try:
+            fields['sendungsnrversender'] = int(fields['sendungsnrversender'])
+        except ValueError:
+            logging.warning('Problem with invalid id %r for STAT record - ignoring'
+                            % fields['sendungsnrversender'])
+            return None
+        return StatusRecord._make([fields[name] for name in StatusRecord._fields])
+
+    def records(self, fileobj):
+        """Reads Fortras STAT data from fileobj and yields a StatusRecord for each valid Q record.
+
+        Lines are read one at a time, so messages of any size are parsed in constant memory.
+        """
+        header = fileobj.readline()
+        if not header:
             logging.error('empty file')
             return
-        if not lines[0].startswith('@@PHSTAT128 0128003500107 MAEULER HUDORA1                       '):
-            raise RuntimeError("illegal status data %r" % data[:300])
-        for line in lines[1:]:
+        if not header.startswith(STAT_HEADER):
+            raise RuntimeError("illegal status data %r" % (header + fileobj.read(300))[:300])
+        for line in fileobj:
+            line = line.rstrip('\r\n')
             if not line or line[0] == 'X':  # 'X' records and empty lines are ignored
                 continue
-            match = re.search(Statusmeldung.q_record_re, line)
-            newdict = {}
-            if not match:
-                print 'no match', repr(line)
-            for key, value in match.groupdict().items():
-                newdict[key] = value.strip()
-            try:
-                if newdict['time']:
-                    newdict['timestamp'] = datetime.datetime(int(newdict['date'][4:]), int(newdict['date'][2:4]),
-                                                             int(newdict['date'][:2]), int(newdict['time'][:2]),
-                                                             int(newdict['time'][2:]))
-                else:
-                    newdict['timestamp'] = datetime.datetime(int(newdict['date'][4:]), int(newdict['date'][2:4]),
-                                                             int(newdict['date'][:2]))
-            except ValueError:
-                logging.error("malformed timestamp %r|%r" % (newdict['date'], newdict['time']))
-                newdict['timestamp'] = datetime.datetime.now()
-            newdict['statustext'] = Statusmeldung.statustexte.get(int(newdict['sendungsschluessel']))
-            try:
-                newdict['sendungsnrversender'] = int(newdict['sendungsnrversender'])
-                self.update_sendung(newdict['sendungsnrversender'], newdict)
-            except ValueError:
-                logging.warning('Problem with invalid id %r for STAT record - ignoring' % newdict['sendungsnrversender'])
+            record = self.record(line)
+            if record is not None:
+                yield record
+
+    def process(self, fileobj, sink=None):
+        """Reads Fortras STAT data from fileobj and calls sink with every StatusRecord.
+
+        sink defaults to updating huLOG. If sink has a flush() method, it is called at the end.
+        """
+        if sink is None:
+            sink = self.update_record
+        for record in self.records(fileobj):
+            sink(record)
+        if hasattr(sink, 'flush'):
+            sink.flush()
+
+    def update_record(self, record):
+        """Sink updating the huLOG Sendung of record."""
+        self.update_sendung(record.sendungsnrversender, record._asdict())
+
+    def parse(self, data, sink=None):
+        """Parses Fortras STAT data given as str or unicode, see process()."""
+        self.process(StringIO(data), sink)
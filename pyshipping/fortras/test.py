@@ -7,8 +7,11 @@ Created by Maximillian Dornseif on 2006-11-19.
 You may consider this BSD licensed.
 """
 
+import datetime
 import unittest
+from cStringIO import StringIO
 from pyshipping.fortras.bordero import _clip, Bordero
+from pyshipping.fortras.fortras_stat import Statusmeldung, BatchWriter, STAT_HEADER
 
 _nvecount = 0
 
@@ -73,63 +76,67 @@ class BorderoTests(unittest.TestCase):
         bordero.add_lieferung(TestLieferung())
         bordero.generate_dataexport()
 
+    def test_summensatz_europaletten(self):
+        bordero = Bordero()
+        bordero.add_lieferung(TestLieferung())
+        self.assertEqual(bordero.generate_summensatz_l()[70:73], '002')
+        lieferung = TestLieferung()
+        lieferung.europaletten = 1
+        bordero.add_lieferung(lieferung)
+        self.assertEqual(bordero.generate_summensatz_l()[70:73], '003')
+
+
+STAT_DATA = (STAT_HEADER + '\r\n'
+             + 'Q11515     L00000000000000395176882         054061120061615                  '
+             + 'ROLLKARTE 421/6902                                5\r\n'
+             + 'Q11515     L65827812        5178928         012171120060827   THOMA                          '
+             + '                                  5\r\n'
+             + 'X\r\n'
+             + '\r\n'
+             + 'Q11515     L6350706         5178934         054171120060726                                  '
+             + '                                  5\r\n'
+             + 'Q11515     Lkaputt          5178934         054171120060726                                  '
+             + '                                  5\r\n'
+             + 'Q11515     L6350706         5178934         0541711200607\r\n')
+
+
+class StatTests(unittest.TestCase):
+
+    def test_records(self):
+        records = list(Statusmeldung().records(StringIO(STAT_DATA)))
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0].sendungsnrversender, 39)
+        self.assertEqual(records[0].sendungsnrempfaenger, '5176882')
+        self.assertEqual(records[0].sendungsschluessel, '054')
+        self.assertEqual(records[0].timestamp, datetime.datetime(2006, 11, 6, 16, 15))
+        self.assertEqual(records[0].zusatztext, 'ROLLKARTE 421/6902')
+        self.assertEqual(records[0].statustext, 'Sendung auf dem Weg zum Empfänger / in Zustellung')
+        self.assertEqual(records[1].quittungsgeber, 'THOMA')
+        self.assertEqual(records[1]._asdict()['sendungsnrversender'], 65827812)
+
+    def test_header(self):
+        self.assertEqual(list(Statusmeldung().records(StringIO(''))), [])
+        self.assertRaises(RuntimeError, list,
+                          Statusmeldung().records(StringIO('@@PHENTL128' + STAT_DATA[11:])))
+
+    def test_sinks(self):
+        records = []
+        Statusmeldung().parse(STAT_DATA, records.append)
+        self.assertEqual([record.sendungsnrversender for record in records], [39, 65827812, 6350706])
+        batches = []
+        Statusmeldung().process(StringIO(STAT_DATA), BatchWriter(batches.append, batchsize=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertEqual(batches[0] + batches[1], records)
+
+    def test_unicode(self):
+        records = []
+        Statusmeldung().parse(STAT_DATA.decode('ascii').replace(u'THOMA ', u'M\xdcLLER'), records.append)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[1].quittungsgeber, u'M\xdcLLER')
+
 
 # The following tests have an ugly circular dependency to huLOG - this needs fixing
 
-# class StatTests(unittest.TestCase):
-#
-#     def test_status(self):
-#         tesdata = '''@@PHSTAT128 0128003500107 MAEULER HUDORA1
-# Q11515     L00000000000000545177124         091071120061106                                                                    5\
-# '''
-#         stat = Statusmeldung()
-#         #stat.parse(tesdata)
-#
-#         testdata = '''@@PHSTAT128 0128003500107 MAEULER HUDORA1
-# Q11515     L00000000000000395176882         054061120061615                  ROLLKARTE 421/6902                                5
-# Q11515     L00000000000000385176883         054061120061615                  ROLLKARTE 421/6902                                5
-# Q11515     L00000000000000375176884         054061120061615                  ROLLKARTE 421/6902                                5
-# Q11515     L00000000000000365176885         054061120061615                  ROLLKARTE 421/6902                                5
-# Q11515     L00000000000000355176886         054061120061615                  ROLLKARTE 421/6902                                5
-# Q11515     L00000000000000345176887         054061120061615                  ROLLKARTE 421/6902                                5
-# Q11515     L00000000000000335176888         054061120061615                  ROLLKARTE 421/6902                                5
-# Q11515     L00000000000000325176890         054061120061615                  ROLLKARTE 421/6902                                5
-# '''
-#         stat.parse(testdata)
-#
-#         testdata = '''@@PHSTAT128 0128003500107 MAEULER HUDORA1
-# Q11515     L00000000000000395176882         012111120061111   UNTERSCHRIFT                                                     5
-# Q11515     L00000000000000385176883         012111120061111   UNTERSCHRIFT                                                     5
-# Q11515     L00000000000000375176884         012111120061111   UNTERSCHRIFT                                                     5
-# Q11515     L00000000000000365176885         012111120061111   UNTERSCHRIFT                                                     5
-# Q11515     L00000000000000355176886         012111120061111   UNTERSCHRIFT                                                     5
-# Q11515     L00000000000000345176887         012111120061111   UNTERSCHRIFT                                                     5
-# Q11515     L00000000000000335176888         012111120061111   UNTERSCHRIFT                                                     5
-# Q11515     L00000000000000325176890         012111120061111   UNTERSCHRIFT                                                     5
-# '''
-#         stat.parse(testdata)
-#
-#         testdata = '''@@PHSTAT128 0128003500107 MAEULER HUDORA1
-# Q11515     L00000000009106405176617         012031120061500   TESTNAME                                                         5
-# Q11515     L00000000009109205176618         012031120061501   TESTNAME2                                                        5
-# Q11515     L00000000009111205176619         012031120061510   TESTNAME3                                                        5
-# '''
-#         stat.parse(testdata)
-#
-#         testdata = '''@@PHSTAT128 0128003500107 MAEULER HUDORA1
-# Q11515     L65827812        5178928         054171120060745                                                                    5
-# Q11515     L65827812        5178928         012171120060827   THOMA                                                            5
-# Q11515     L232740          5178930         054171120060922                                                                    5
-# '''
-#         stat.parse(testdata)
-#
-#         testdata = '''@@PHSTAT128 0128003500107 MAEULER HUDORA1
-# Q11515     L6350706         5178934         054171120060726                                                                    5
-# Q11515     L6350706         5178934         012171120060911   PATER                                                            5
-# '''
-#         stat.parse(testdata)
-#
-#
 # class EntlTests(unittest.TestCase):
 #
 #     def test_entladebericht(self):
@@ -12,6 +12,14 @@ import doctest
 import unittest
 
 
+# maximum number of cartons strapped together into a single bundle
+MAXKARTONSIMBUENDEL = 6
+# upper bound for the number of distinct Packages kept by Package.of()
+INTERN_CACHE_SIZE = 10000
+_interned = {}
+_interned_raw = {}
+
+
 class Package(object):
     """Represents a package as used in cargo/shipping aplications."""
 
@@ -36,6 +44,34 @@ class Package(object):
         self.volume = self.heigth * self.width * self.length
         self.size = (self.heigth, self.width, self.length)
 
+    @classmethod
+    def of(cls, size, weight=0):
+        """Returns a shared, immutable Package for the given dimensions and weight.
+
+        Packages are interned by their canonical (sorted) dimensions and weight, so repeated
+        SKUs share a single object and compare by identity:
+        >>> Package.of('580x140x60') is Package.of((60, 140, 580))
+        True
+        >>> Package.of('580x140x60').weight = 5
+        Traceback (most recent call last):
+        ...
+        AttributeError: interned Package objects are immutable
+        """
+        if isinstance(size, list):
+            size = tuple(size)
+        rawkey = (size, weight)
+        package = _interned_raw.get(rawkey)
+        if package is not None:
+            return package
+        if len(_interned_raw) >= INTERN_CACHE_SIZE:
+            # crude but cheap: start over instead of tracking usage
+            _interned_raw.clear()
+            _interned.clear()
+        package = _FrozenPackage(size, weight)
+        package = _interned.setdefault((package.size, weight), package)
+        _interned_raw[rawkey] = package
+        return package
+
     def _get_gurtmass(self):
         """'gurtamss' is the circumference of the box plus the length - which is often used to
             calculate shipping costs.
@@ -51,13 +87,22 @@ class Package(object):
         return maxdimension + 2 * (sum(otherdimensions))
     gurtmass = property(_get_gurtmass)
 
+    def _get_seiten(self):
+        """Die drei Seitenflächen des Packstücks als (grössere Kante, kleinere Kante).
+
+            >>> Package((100,110,120)).seiten
+            ((120, 110), (120, 100), (110, 100))
+        """
+        return ((self.heigth, self.width), (self.heigth, self.length), (self.width, self.length))
+    seiten = property(_get_seiten)
+
     def hat_gleiche_seiten(self, other):
         """Prüft, ob other mindestens eine gleich grosse Seite mit self hat."""
-
-        meineseiten = set([(self.heigth, self.width), (self.heigth, self.length), (self.width, self.length)])
-        otherseiten = set([(other.heigth, other.width), (other.heigth, other.length),
-                           (other.width, other.length)])
-        return bool(meineseiten.intersection(otherseiten))
+        otherseiten = other.seiten
+        for seite in self.seiten:
+            if seite in otherseiten:
+                return True
+        return False
 
     def __getitem__(self, key):
         """The coordinates can be accessed as if the object is a tuple.
@@ -100,6 +145,8 @@ class Package(object):
            >>> Package((120,110,100)) == Package((100,110,120))
            True
         """
+        if self is other:
+            return True
         return (self.heigth == other.heigth and self.width == other.width and self.length == other.length)
 
     def __cmp__(self, other):
@@ -128,10 +175,8 @@ class Package(object):
             >>> Package((1600, 250, 480)) + Package((1600, 490, 480))
             <Package 1600x740x480>
             """
-        meineseiten = set([(self.heigth, self.width), (self.heigth, self.length),
-                           (self.width, self.length)])
-        otherseiten = set([(other.heigth, other.width), (other.heigth, other.length),
-                           (other.width, other.length)])
+        meineseiten = set(self.seiten)
+        otherseiten = set(other.seiten)
         if not meineseiten.intersection(otherseiten):
             raise ValueError("%s has no fitting sites to %s" % (self, other))
         candidates = sorted(meineseiten.intersection(otherseiten), reverse=True)
@@ -163,6 +208,19 @@ class Package(object):
             return "<Package %dx%dx%d>" % (self.heigth, self.width, self.length)
 
 
+class _FrozenPackage(Package):
+    """A Package which can't be changed after creation. Used by Package.of()."""
+
+    def __init__(self, size, weight=0):
+        super(_FrozenPackage, self).__init__(size, weight)
+        self.__dict__['_frozen'] = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen'):
+            raise AttributeError("interned Package objects are immutable")
+        super(_FrozenPackage, self).__setattr__(name, value)
+
+
 def buendelung(kartons, maxweight=31000, maxgurtmass=3000):
     """Versucht Pakete so zu bündeln, so dass das Gurtmass nicht überschritten wird.
 
@@ -174,6 +232,7 @@ def buendelung(kartons, maxweight=31000, maxgurtmass=3000):
     (2, [<Package 800x750x310>, <Package 500x450x290>], [<Package 800x310x250>])
     """
     kartons = list(kartons)
+    kartons.reverse()  # so we can cheaply pop() from the end
 
     def buendelung_moeglich(box_a, box_b):
         """Entscheide, ob eine Bündelung der beiden Kartons möglich ist.
@@ -194,17 +253,16 @@ def buendelung(kartons, maxweight=31000, maxgurtmass=3000):
             return False
         return True
 
-    MAXKARTONSIMBUENDEL = 6
     if not kartons:
         return 0, [], kartons
     gebuendelt = []
     rest = []
-    lastcarton = kartons.pop(0)
+    lastcarton = kartons.pop()
     buendel = False
     buendelcounter = 0
     kartons_im_buendel = 1
     while kartons:
-        currentcarton = kartons.pop(0)
+        currentcarton = kartons.pop()
         # check if 2 dimensions fit and bundling is possible
         if currentcarton.hat_gleiche_seiten(lastcarton) and buendelung_moeglich(lastcarton, currentcarton):
             # new carton has the same size in two dimensions and the sum of both in the third
@@ -230,6 +288,82 @@ def buendelung(kartons, maxweight=31000, maxgurtmass=3000):
     return buendelcounter, gebuendelt, rest
 
 
+def _gurtmass(seite, hoehe):
+    """Gurtmass eines Bündels mit der Grundfläche seite und der Stapelhöhe hoehe."""
+    return 2 * (seite[0] + seite[1] + hoehe) - max(seite[0], hoehe)
+
+
+def optimale_buendelung(kartons, maxweight=31000, maxgurtmass=3000):
+    """Bündelt Pakete mit gleich grossen Seiten unabhängig von ihrer Reihenfolge.
+
+    Im Gegensatz zu buendelung() werden nicht nur benachbarte Kartons betrachtet. Die Kartons werden
+    über einen Index ihrer Seitenflächen gruppiert, häufige Seitenflächen werden zuerst bearbeitet.
+    Innerhalb einer Gruppe werden die Kartons nach Stapelhöhe sortiert und so lange auf ein Bündel
+    gestapelt, wie Gewicht, Gurtmass und MAXKARTONSIMBUENDEL es zulassen. Kartons, die in einer
+    Gruppe allein bleiben, können noch in einer anderen Gruppe gebündelt werden.
+    Die Laufzeit ist O(n log n).
+
+    Gibt wie buendelung() die Anzahl der Bündel, die gebündelten Pakete und die nicht bündelbaren
+    Pakete zurück.
+
+    >>> optimale_buendelung([Package((800, 310, 250)), Package((450, 290, 250)), Package((800, 310, 250)), Package((450, 290, 250))])
+    (2, [<Package 800x500x310>, <Package 500x450x290>], [])
+    >>> optimale_buendelung([Package((800, 310, 250)), Package((800, 310, 250)), Package((800, 310, 250)), Package((800, 310, 250))])
+    (1, [<Package 800x750x310>], [<Package 800x310x250>])
+    """
+    kartons = list(kartons)
+    index = {}
+    for nr, karton in enumerate(kartons):
+        for seite in set(karton.seiten):
+            index.setdefault(seite, []).append(nr)
+    # popular faces first, bigger faces before smaller ones
+    seiten = sorted(index.keys(), key=lambda seite: (-len(index[seite]), -seite[0], -seite[1]))
+
+    frei = [True] * len(kartons)
+    gebuendelt = []
+    for seite in seiten:
+        kandidaten = []
+        for nr in index[seite]:
+            if frei[nr]:
+                karton = kartons[nr]
+                hoehe = karton.volume // (seite[0] * seite[1])
+                kandidaten.append((hoehe, karton.weight or 0, nr))
+        if len(kandidaten) < 2:
+            continue
+        # smallest cartons first results in the most cartons per bundle
+        kandidaten.sort()
+        buendel = []
+        for hoehe, gewicht, nr in kandidaten:
+            if buendel and (len(buendel) >= MAXKARTONSIMBUENDEL
+                            or _gurtmass(seite, stapelhoehe + hoehe) > maxgurtmass
+                            or stapelgewicht + gewicht > maxweight):
+                if len(buendel) > 1:
+                    gebuendelt.append(_buendel_erzeugen(seite, stapelhoehe, buendel, kartons, frei))
+                buendel = []
+            if not buendel:
+                stapelhoehe = stapelgewicht = 0
+            buendel.append(nr)
+            stapelhoehe += hoehe
+            stapelgewicht += gewicht
+        if len(buendel) > 1:
+            gebuendelt.append(_buendel_erzeugen(seite, stapelhoehe, buendel, kartons, frei))
+    rest = [karton for nr, karton in enumerate(kartons) if frei[nr]]
+    return len(gebuendelt), gebuendelt, rest
+
+
+def _buendel_erzeugen(seite, stapelhoehe, buendel, kartons, frei):
+    """Erzeugt das Package für ein Bündel und markiert die enthaltenen Kartons als vergeben."""
+    gewicht = 0
+    for nr in buendel:
+        frei[nr] = False
+        if gewicht is not None and kartons[nr].weight:
+            gewicht += kartons[nr].weight
+        else:
+            # like Package.__add__() we only sum up if all weights are known
+            gewicht = None
+    return Package((seite[0], seite[1], stapelhoehe), gewicht)
+
+
 def pack_in_bins(kartons, versandkarton):
     """Implements Bin-Packing.
 
@@ -293,6 +427,31 @@ class PackageTests(unittest.TestCase):
         """Test multiplication."""
         self.assertEqual(Package((200, 200, 200)), Package((100, 200, 200)) * 2)
 
+    def test_of(self):
+        """Test interning of Packages."""
+        self.assertTrue(Package.of('580x140x60') is Package.of('580x140x60'))
+        self.assertTrue(Package.of([140, 60, 580]) is Package.of('60x140x580'))
+        self.assertFalse(Package.of('580x140x60', 1200) is Package.of('580x140x60'))
+        self.assertEqual(Package.of('580x140x60', 1200).weight, 1200)
+        self.assertEqual(Package.of('580x140x60'), Package('580x140x60'))
+        self.assertEqual(hash(Package.of('580x140x60')), hash(Package('580x140x60')))
+
+    def test_optimale_buendelung(self):
+        """Test bundling of non-adjacent cartons."""
+        kartons = [Package((800, 310, 250), 5000), Package((450, 290, 250), 3000)] * 4
+        anzahl, gebuendelt, rest = optimale_buendelung(kartons)
+        self.assertEqual(anzahl, 2)
+        # a fourth carton would exceed the maximum gurtmass
+        self.assertEqual(rest, [Package((800, 310, 250), 5000)])
+        self.assertEqual(sorted(x.weight for x in gebuendelt), [12000, 15000])
+        # the weight limit splits bundles
+        anzahl, gebuendelt, rest = optimale_buendelung([Package((450, 290, 250), 3000)] * 6, maxweight=9000)
+        self.assertEqual((anzahl, [x.weight for x in gebuendelt], rest), (2, [9000, 9000], []))
+        # never more than MAXKARTONSIMBUENDEL cartons in a bundle
+        anzahl, gebuendelt, rest = optimale_buendelung([Package((300, 200, 10))] * 8)
+        self.assertEqual(gebuendelt, [Package((300, 200, 60)), Package((300, 200, 20))])
+        self.assertEqual(optimale_buendelung([]), (0, [], []))
+
     def test_sort(self):
         """Test multiplication."""
         data = [Package((1600, 490, 480)), Package((1600, 470, 480)), Package((1600, 480, 480))]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+pallet.py - build pallet loads from cartons
+
+Cartons (Package objects with weights) are packed onto pallets using the bin packing implementation in
+binpack_simple. The usable space of a pallet is modelled as a Package, the load capacity is checked
+separately.
+
+You might consider this BSD-Licensed.
+"""
+
+import unittest
+from pyshipping import binpack_simple
+from pyshipping.package import Package
+
+
+class PalletType(object):
+    """Describes a kind of pallet: usable load space and maximum load weight in g."""
+
+    def __init__(self, name, verpackungsart, size, maxweight):
+        self.name = name
+        # Fortras code for this kind of packaging, see fortras/bordero.py
+        self.verpackungsart = verpackungsart
+        self.size = Package(size)
+        self.maxweight = maxweight
+
+    def __repr__(self):
+        return "<PalletType %s %s %dg>" % (self.name, self.size, self.maxweight)
+
+
+# load heigth is 1800 mm minus the pallet itself
+EUROPALETTE = PalletType('Europalette', 'FP', (1200, 800, 1650), 1000000)
+HALBPALETTE = PalletType('Halbpalette', 'HP', (800, 600, 1650), 500000)
+EINWEGPALETTE = PalletType('Einwegpalette', 'EP', (1200, 800, 1650), 750000)
+
+
+def _pallet_weight(pallet):
+    return sum([package.weight or 0 for package in pallet])
+
+
+def _pack(size, packages):
+    """Packs packages with every orientation of the pallet and returns the result with the fewest pallets.
+
+    packit() doesn't rotate packages, so rotating the pallet is a cheap way to try different orientations
+    for all of them at once. This works well with the rather uniform cartons of a single shipment.
+    """
+    best = None
+    for dimensions in set(binpack_simple.permutations(size.size)):
+        bins, rest = binpack_simple.packit(Package(dimensions, nosort=True), packages)
+        if not rest and (best is None or len(bins) < len(best)):
+            best = bins
+    return best
+
+
+def build_pallets(packages, pallettype=EUROPALETTE):
+    """Packs Packages onto pallets of the given PalletType.
+
+    Returns a list of pallets (each a list of Packages) and a list of Packages which are too big or too
+    heavy to be put on a pallet of this type at all.
+
+    >>> pallets, toobig = build_pallets([Package('580x400x300', 12000)] * 50)
+    >>> [len(x) for x in pallets], toobig
+    ([20, 20, 10], [])
+    """
+    toobig, todo = [], []
+    for package in packages:
+        if package not in pallettype.size or (package.weight or 0) > pallettype.maxweight:
+            toobig.append(package)
+        else:
+            todo.append(package)
+
+    pallets = []
+    while todo:
+        bins = _pack(pallettype.size, todo)
+        todo = []
+        for pallet in bins:
+            # packit() only looks at the dimensions: take the heaviest cartons off overloaded pallets
+            # and pack them again in the next round
+            if _pallet_weight(pallet) > pallettype.maxweight:
+                pallet = sorted(pallet, key=lambda package: package.weight or 0)
+                while _pallet_weight(pallet) > pallettype.maxweight:
+                    todo.append(pallet.pop())
+            pallets.append(pallet)
+    return pallets, toobig
+
+
+def count_pallets(packages, pallettype=EUROPALETTE):
+    """Returns the number of pallets needed to ship packages.
+
+    Packages which don't fit onto a pallet are counted as one pallet each.
+    """
+    pallets, toobig = build_pallets(packages, pallettype)
+    return len(pallets) + len(toobig)
+
+
+class PalletTests(unittest.TestCase):
+    """Tests for pallet building."""
+
+    def test_empty(self):
+        """Nothing to pack results in no pallets."""
+        self.assertEqual(build_pallets([]), ([], []))
+        self.assertEqual(count_pallets([]), 0)
+
+    def test_volume(self):
+        """Cartons are spread over several pallets if they don't fit on one."""
+        pallets, toobig = build_pallets([Package('580x400x300', 12000)] * 50)
+        self.assertEqual(sum([len(x) for x in pallets]), 50)
+        self.assertEqual(len(pallets), 3)
+        self.assertEqual(len(build_pallets([Package('580x400x300', 12000)] * 50, HALBPALETTE)[0]), 5)
+
+    def test_weight(self):
+        """The maximum load of a pallet is respected."""
+        pallets, toobig = build_pallets([Package('300x200x200', 100000)] * 12)
+        self.assertEqual([len(x) for x in pallets], [10, 2])
+        self.assertEqual(count_pallets([Package('300x200x200', 100000)] * 12, EINWEGPALETTE), 2)
+
+    def test_toobig(self):
+        """Packages not fitting onto a pallet are returned seperately and counted as pallets."""
+        pallets, toobig = build_pallets([Package('2000x200x200'), Package('300x200x200', 2000000),
+                                         Package('300x200x200')])
+        self.assertEqual(len(pallets), 1)
+        self.assertEqual(len(toobig), 2)
+        self.assertEqual(count_pallets([Package('2000x200x200'), Package('300x200x200')]), 2)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+    unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+postcode.py - normalisation and validation rules for postcodes
+
+PostcodeRules compiles for every country the regular expressions needed to clean up a postcode (strip
+country prefixes like 'D-' or 'FR-', spaces and dashes) and to check its format. The rules are shared by
+addressvalidation and the DPD router, see georoute.get_postcoderules() for the rules built from the DPD
+COUNTRY table.
+
+You might consider this BSD-Licensed.
+"""
+
+import re
+import unittest
+
+
+# Quelle: http://de.wikipedia.org/wiki/Liste_der_Kfz-Nationalitätszeichen
+# only countries with numeric postcodes, so stripping the letters is unambiguous
+CARCODES = {
+    'AT': 'A',
+    'BE': 'B',
+    'DE': 'D',
+    'ES': 'E',
+    'FR': 'F',
+    'HU': 'H',
+    'IT': 'I',
+    'LU': 'L',
+    'NO': 'N',
+    'PT': 'P',
+    'SE': 'S',
+}
+
+# postcode formats after normalisation (upper case, no spaces and dashes)
+FORMATS = {
+    'AD': r'AD\d{3}',
+    'AT': r'\d{4}',
+    'BE': r'\d{4}',
+    'BG': r'\d{4}',
+    'CH': r'\d{4}',
+    'CZ': r'\d{5}',
+    'DE': r'\d{5}',
+    'DK': r'\d{4}',
+    'EE': r'\d{5}',
+    'ES': r'\d{5}',
+    'FI': r'\d{5}',
+    'FR': r'\d{5}',
+    'GB': r'[A-Z]{1,2}\d[A-Z\d]?\d[A-Z]{2}',
+    'GG': r'GY\d[A-Z\d]?\d[A-Z]{2}',
+    'GR': r'\d{5}',
+    'HR': r'\d{5}',
+    'HU': r'\d{4}',
+    'IM': r'IM\d[A-Z\d]?\d[A-Z]{2}',
+    'IT': r'\d{5}',
+    'JE': r'JE\d[A-Z\d]?\d[A-Z]{2}',
+    'LI': r'\d{4}',
+    'LT': r'\d{5}',
+    'LU': r'\d{4}',
+    'LV': r'\d{4}',
+    'NL': r'\d{4}[A-Z]{2}',
+    'NO': r'\d{4}',
+    'PL': r'\d{5}',
+    'PT': r'\d{4}(\d{3})?',
+    'RO': r'\d{6}',
+    'SE': r'\d{5}',
+    'SI': r'\d{4}',
+    'SK': r'\d{5}',
+}
+DEFAULT_FORMAT = r'[A-Z\d]{1,10}'
+# countries whose postcodes start with the country code, e.g. 'JE2 3AB'
+OWN_PREFIX = set([country for country, fmt in FORMATS.items() if fmt.startswith(country)])
+
+# DPD routes IE by area (1 Dublin, 2 rest of Ireland), so the postcode can be left out
+POSTCODE_OPTIONAL = set(['IE'])
+
+# prefixes of foreign postcodes often found in german addresses, e.g. 'A-1210 Wien'
+_FOREIGN_PREFIXES = re.compile(r'(CH|BE|B|AT|A)-', re.IGNORECASE)
+_FOREIGN_COUNTRIES = {'CH': 'CH', 'BE': 'BE', 'B': 'BE', 'AT': 'AT', 'A': 'AT'}
+_SEPARATORS = re.compile(r'[\s-]+')
+
+
+class PostcodeRules(object):
+    """Compiled postcode rules for a set of countries.
+
+    `countries` is a sequence of (ISO alpha-2 code, has postcodes) tuples, e.g. from the DPD COUNTRY
+    table. Countries not listed get generic rules.
+    """
+
+    def __init__(self, countries=()):
+        self.rules = {}
+        for country, has_postcodes in countries:
+            country = country.upper()
+            self.rules[country] = self._compile(country, has_postcodes)
+
+    def _compile(self, country, has_postcodes=True):
+        """Returns (prefix regex, format regex, postcode required, own prefix) for country."""
+        prefixes = [re.escape(country)]
+        if country in CARCODES:
+            prefixes.append(CARCODES[country])
+        # '-' is stripped as part of the prefix, so 'D-', 'DE-' and '-' all match
+        prefix = re.compile(r'(?:-|%s)*' % '|'.join(prefixes), re.IGNORECASE)
+        fmt = re.compile(r'(?:%s)$' % FORMATS.get(country, DEFAULT_FORMAT))
+        own_prefix = country in OWN_PREFIX and country or ''
+        return prefix, fmt, has_postcodes and country not in POSTCODE_OPTIONAL, own_prefix
+
+    def _rule(self, country):
+        rule = self.rules.get(country)
+        if rule is None:
+            rule = self.rules[country] = self._compile(country)
+        return rule
+
+    def normalize(self, country, postcode):
+        """Returns the cleaned up (country, postcode) tuple.
+
+        The country is upper cased, the postcode is upper cased and freed from spaces, dashes and country
+        prefixes. Foreign prefixes in german postcodes change the country. Countries like JE, whose postcodes
+        start with the country code, get it (back) in front of the postcode.
+
+        >>> rules = PostcodeRules()
+        >>> rules.normalize('de', 'D-42897')
+        ('DE', '42897')
+        >>> rules.normalize('DE', 'A-1210')
+        ('AT', '1210')
+        >>> rules.normalize('GB', 'gu14 8hn')
+        ('GB', 'GU148HN')
+        >>> rules.normalize('JE', 'JE2 3AB')
+        ('JE', 'JE23AB')
+        """
+        country = country.strip().upper()
+        if not postcode:
+            return country, postcode
+        postcode = postcode.replace(' ', '')
+        postcode = postcode[self._rule(country)[0].match(postcode).end():]
+        if country == 'DE':
+            match = _FOREIGN_PREFIXES.match(postcode)
+            if match:
+                country = _FOREIGN_COUNTRIES[match.group(1).upper()]
+                postcode = postcode[match.end():]
+                postcode = postcode[self._rule(country)[0].match(postcode).end():]
+        return country, self._rule(country)[3] + _SEPARATORS.sub('', postcode).upper()
+
+    def needs_postcode(self, country):
+        """Returns False if addresses in country (normalized) can do without a postcode."""
+        return self._rule(country)[2]
+
+    def check_format(self, country, postcode):
+        """Checks a normalized postcode against the format of the normalized country."""
+        return self._rule(country)[1].match(postcode) is not None
+
+
+class PostcodeRulesTests(unittest.TestCase):
+    """Tests for postcode rules."""
+
+    def setUp(self):
+        self.rules = PostcodeRules([('DE', True), ('AT', True), ('IE', True), ('HK', False), ('LV', True)])
+
+    def test_normalize(self):
+        """Prefixes, spaces and dashes are removed."""
+        self.assertEqual(self.rules.normalize('DE', '42897'), ('DE', '42897'))
+        self.assertEqual(self.rules.normalize(' de ', ' D - 42897'), ('DE', '42897'))
+        self.assertEqual(self.rules.normalize('DE', 'DE-42897'), ('DE', '42897'))
+        self.assertEqual(self.rules.normalize('FR', 'f66400'), ('FR', '66400'))
+        self.assertEqual(self.rules.normalize('FR', 'FR-F-66400'), ('FR', '66400'))
+        self.assertEqual(self.rules.normalize('LV', 'LV-1050'), ('LV', '1050'))
+        self.assertEqual(self.rules.normalize('PL', '00-950'), ('PL', '00950'))
+        self.assertEqual(self.rules.normalize('DE', ''), ('DE', ''))
+        self.assertEqual(self.rules.normalize('DE', None), ('DE', None))
+
+    def test_own_prefix(self):
+        """Postcodes starting with the country code keep it."""
+        self.assertEqual(self.rules.normalize('JE', 'JE2 3AB'), ('JE', 'JE23AB'))
+        self.assertEqual(self.rules.normalize('JE', '2 3AB'), ('JE', 'JE23AB'))
+        self.assertEqual(self.rules.normalize('IM', 'im1 1ad'), ('IM', 'IM11AD'))
+        self.assertEqual(self.rules.normalize('AD', 'AD500'), ('AD', 'AD500'))
+        self.assertEqual(self.rules.normalize('AD', 'AD-AD500'), ('AD', 'AD500'))
+        for country, postcode in [('JE', 'JE23AB'), ('IM', 'IM11AD'), ('AD', 'AD500')]:
+            self.assertTrue(self.rules.check_format(country, postcode))
+
+    def test_foreign_prefixes(self):
+        """Foreign prefixes in german postcodes change the country."""
+        self.assertEqual(self.rules.normalize('DE', 'CH-8000'), ('CH', '8000'))
+        self.assertEqual(self.rules.normalize('DE', 'b-3960'), ('BE', '3960'))
+        self.assertEqual(self.rules.normalize('DE', 'BE-3960'), ('BE', '3960'))
+        self.assertEqual(self.rules.normalize('DE', 'AT-1210'), ('AT', '1210'))
+        self.assertEqual(self.rules.normalize('DE', 'A-1210'), ('AT', '1210'))
+        self.assertEqual(self.rules.normalize('FR', 'A-1210'), ('FR', 'A1210'))
+
+    def test_format(self):
+        """Postcode formats are checked per country."""
+        self.assertTrue(self.rules.check_format('DE', '42897'))
+        self.assertFalse(self.rules.check_format('DE', '4289'))
+        self.assertFalse(self.rules.check_format('DE', '428977'))
+        self.assertTrue(self.rules.check_format('NL', '1234AB'))
+        self.assertTrue(self.rules.check_format('GB', 'GU148HN'))
+        self.assertTrue(self.rules.check_format('GB', 'W1A1AA'))
+        self.assertFalse(self.rules.check_format('GB', '$$$'))
+        self.assertTrue(self.rules.check_format('XX', 'AB12'))
+        self.assertFalse(self.rules.check_format('XX', 'AB12$'))
+        self.assertTrue(self.rules._rule('XX') is self.rules._rule('XX'))
+
+    def test_needs_postcode(self):
+        """Some countries have no postcodes."""
+        self.assertTrue(self.rules.needs_postcode('DE'))
+        self.assertFalse(self.rules.needs_postcode('IE'))
+        self.assertFalse(self.rules.needs_postcode('HK'))
+        self.assertTrue(self.rules.needs_postcode('XX'))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+    unittest.main()
@@ -8,8 +8,54 @@ Created by Maximillian Dornseif on 2007-07-11. Based on code from 2007-04-17.
 Copyright (c) 2007 HUDORA GmbH. All rights reserved.
 """
 
+import itertools
 import unittest
 import math
+from pyshipping.package import Package
+from pyshipping.pallet import build_pallets, count_pallets, EUROPALETTE
+
+
+# Transportwege
+KEP = 'KEP'  # Paketdienst
+FRACHT = 'Fracht'  # Stueckgut per Spedition (Fortras BORD)
+KOMPLETTLADUNG = 'Komplettladung'  # eigener LKW
+
+
+class Versandregeln(object):
+    """Entscheidet anhand einstellbarer Grenzwerte über den Transportweg einer Lieferung.
+
+    kep() und komplettladung() verwenden nur Vergleiche und & bzw. |, sie funktionieren deshalb mit
+    einzelnen Werten genauso wie mit NumPy Arrays (siehe shipmenttable.py).
+    """
+
+    def __init__(self, kep_max_kartons=10, kep_max_gewicht=31500, kep_max_gurtmass=3000,
+                 komplettladung_paletten=33, komplettladung_gewicht=24000000):
+        self.kep_max_kartons = kep_max_kartons
+        self.kep_max_gewicht = kep_max_gewicht
+        self.kep_max_gurtmass = kep_max_gurtmass
+        self.komplettladung_paletten = komplettladung_paletten
+        self.komplettladung_gewicht = komplettladung_gewicht
+
+    def kep(self, export_kartons, max_packstueck_gewicht, max_gurtmass=0):
+        """Kann mit einem Paketdienst verschickt werden? Ein Gurtmass von 0 steht für unbekannt."""
+        return ((export_kartons <= self.kep_max_kartons)
+                & (max_packstueck_gewicht <= self.kep_max_gewicht)
+                & (max_gurtmass <= self.kep_max_gurtmass))
+
+    def komplettladung(self, versandpaletten, gewicht):
+        """Lohnt sich ein eigener LKW?"""
+        return (versandpaletten >= self.komplettladung_paletten) | (gewicht >= self.komplettladung_gewicht)
+
+    def transportweg(self, lieferung):
+        """Gibt KEP, FRACHT oder KOMPLETTLADUNG für lieferung zurück."""
+        if self.komplettladung(lieferung.versandpaletten, lieferung.gewicht):
+            return KOMPLETTLADUNG
+        if self.kep(lieferung.export_kartons, lieferung.max_packstueck_gewicht, lieferung.max_gurtmass):
+            return KEP
+        return FRACHT
+
+
+VERSANDREGELN = Versandregeln()
 
 
 class AbstractPackstueck(object):
@@ -28,6 +74,8 @@ class AbstractItem(object):
         #self.produkte_pro_exportkarton = None
         #self.einzelvolumen = None
         #self.einzelgewicht = None
+        # optional, dimensions of the export package as accepted by Package(), e.g. '580x140x60'
+        #self.exportkarton_abmessungen = None
         self.menge = None
 
     def __unicode__(self):
@@ -80,20 +128,64 @@ class AbstractItem(object):
         """Returns the number of export packages needed to fullfill this item as a float."""
         return self.menge / float(self.produkte_pro_exportkarton)
 
+    @property
+    def export_karton_gewichte_kompakt(self):
+        """Returns the weights of the estimated packages in gramms in compact form.
+
+        The result is a tuple (weight of a full export package, number of full export packages,
+        weight of the last package). The last package takes the remaining products, even if it is full.
+        Weights which are not needed are None.
+
+        >>> item = AbstractItem()
+        >>> item.menge, item.produkte_pro_exportkarton, item.einzelgewicht = 11, 4, 100
+        >>> item.gewicht_pro_exportkarton = 450
+        >>> item.export_karton_gewichte_kompakt
+        (450, 2, 300)
+        >>> item.export_karton_gewichte
+        [450, 450, 300]
+        """
+        menge = self.menge
+        if not menge:
+            return (None, 0, None)
+        anzahl = int(-(-menge // self.produkte_pro_exportkarton)) - 1
+        rest = (menge - anzahl * self.produkte_pro_exportkarton) * self.einzelgewicht
+        if anzahl:
+            return (self.gewicht_pro_exportkarton, anzahl, rest)
+        return (None, 0, rest)
+
+    def iter_export_karton_gewichte(self):
+        """Iterates over the weights of the estimated packages without building a list."""
+        return _iter_kompakt(self.export_karton_gewichte_kompakt)
+
     @property
     def export_karton_gewichte(self):
         """Returns the weights of the estimated number of packages which will be shipped in gramms."""
-        menge = self.menge
+        return list(self.iter_export_karton_gewichte())
+
+    @property
+    def export_karton_packages(self):
+        """Returns the estimated export packages as Package objects with their weight in g.
+
+        Returns None if the dimensions of the export package are unknown."""
+        abmessungen = getattr(self, 'exportkarton_abmessungen', None)
+        if not abmessungen:
+            return None
+        voll, anzahl, rest = self.export_karton_gewichte_kompakt
         ret = []
-        while menge:
-            if menge > self.produkte_pro_exportkarton:
-                ret.append(self.gewicht_pro_exportkarton)
-                menge -= self.produkte_pro_exportkarton
-            else:
-                ret.append(menge * self.einzelgewicht)
-                menge = 0
+        if anzahl:
+            ret = [Package.of(abmessungen, voll)] * anzahl
+        if rest is not None:
+            ret.append(Package.of(abmessungen, rest))
         return ret
 
+    @property
+    def gurtmass(self):
+        """Returns the gurtmass of the export package or None if its dimensions are unknown."""
+        abmessungen = getattr(self, 'exportkarton_abmessungen', None)
+        if not abmessungen:
+            return None
+        return Package.of(abmessungen).gurtmass
+
     @property
     def packstuecke(self):
         """Returns the absolute number of packages to fullfill this item as an integer.
@@ -111,6 +203,8 @@ class AbstractItem(object):
 class AbstractLieferung(object):
     """Definiert eine Lieferung. Das ist eine Einheit aus Positionen und Packstuecken."""
 
+    versandregeln = VERSANDREGELN
+
     def __init__(self):
         # Wir gehen davon aus, dass folgende arrtibute von ausserhalb oder von abgeleiteten Klassen
         # definiert wird:
@@ -120,8 +214,8 @@ class AbstractLieferung(object):
 
     @property
     def transportweg(self):
-        """Returns the suggested method of shipping."""
-        pass
+        """Returns the suggested method of shipping: KEP, FRACHT or KOMPLETTLADUNG."""
+        return self.versandregeln.transportweg(self)
 
     @property
     def transportzeit(self):
@@ -136,35 +230,64 @@ class AbstractLieferung(object):
         except TypeError:
             return self.liefertermin
 
+    def _aggregate_key(self):
+        # items are compared by identity, model instances compare equal by pk
+        return tuple([(id(item), item.menge) for item in self.itemlist])
+
+    def aggregates(self):
+        """Returns a dict with all aggregated values of the itemlist.
+
+        All values are calculated in a single pass over the itemlist and cached until the itemlist
+        or the menge of an item changes. Call invalidate() if other attributes of items change.
+        Values which could not be calculated are represented by the exception raised while trying.
+        """
+        key = self._aggregate_key()
+        cache = getattr(self, '_aggregate_cache', None)
+        if cache is None or cache[0] != key:
+            # holding references to the items makes sure their ids can't be reused while cached
+            cache = (key, _aggregate(self.itemlist), tuple(self.itemlist))
+            self._aggregate_cache = cache
+        return cache[1]
+
+    def invalidate(self):
+        """Discards cached aggregates."""
+        self._aggregate_cache = None
+
+    def _get_aggregate(self, name):
+        value = self.aggregates()[name]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
     @property
     def anbruch(self):
         """Returns False if this Lieferung contains no items which need a export_package to be opened."""
-        for item in self.itemlist:
-            if item.anbruch:
-                return True
-        return False
+        return self._get_aggregate('anbruch')
 
     @property
     def volumen(self):
         """Returns the volume of all Items in this Lieferung in m^3."""
-        return sum([x.volumen for x in self.itemlist])
+        return self._get_aggregate('volumen')
 
     @property
     def gewicht(self):
         """Returns the gewicht of all Items in this Lieferung in g."""
-        return sum([x.gewicht for x in self.itemlist])
+        return self._get_aggregate('gewicht')
 
     @property
     def max_packstueck_gewicht(self):
         """Returns the highest gewicht of any package in the shippment in g."""
-        if self.itemlist:
-            return max([x.max_packstueck_gewicht for x in self.itemlist])
-        return 0
+        return self._get_aggregate('max_packstueck_gewicht')
+
+    @property
+    def max_gurtmass(self):
+        """Returns the highest gurtmass of any export package in the shippment or 0 if unknown."""
+        return self._get_aggregate('max_gurtmass')
 
     @property
     def paletten(self):
         """Returns the number of pallets of all Items in this Lieferung."""
-        return sum([x.paletten for x in self.itemlist])
+        return self._get_aggregate('paletten')
 
     @property
     def versandpaletten(self):
@@ -176,35 +299,133 @@ class AbstractLieferung(object):
         """Returns the number of estimated picks for this Lieferung.
 
         A pick is defined as accessing a position in the warehouse."""
-        return sum([x.picks for x in self.itemlist])
+        return self._get_aggregate('picks')
 
     @property
     def packstuecke(self):
         """Returns the number of "Greifeinheiten", meaning units to be taken out o the warehouse.
         This is an integer."""
-        return sum([x.packstuecke for x in self.itemlist])
+        return self._get_aggregate('packstuecke')
 
     @property
     def export_kartons(self):
         """Returns the estimated number of packages which will be shipped. This is a float."""
-        return sum([x.export_kartons for x in self.itemlist])
+        return self._get_aggregate('export_kartons')
+
+    @property
+    def export_karton_gewichte_kompakt(self):
+        """Returns the weights of the packages of all items in compact form.
+
+        See AbstractItem.export_karton_gewichte_kompakt for the format of the list entries."""
+        return [box.export_karton_gewichte_kompakt for box in self.itemlist]
+
+    def iter_export_karton_gewichte(self):
+        """Iterates over the weights of the estimated packages without building a list."""
+        return itertools.chain(*[_iter_kompakt(kompakt) for kompakt in self.export_karton_gewichte_kompakt])
 
     @property
     def export_karton_gewichte(self):
         """Returns the weights of the estimated number of packages which will be shipped in gramms."""
+        return list(self.iter_export_karton_gewichte())
+
+    @property
+    def export_karton_packages(self):
+        """Returns the estimated export packages as Package objects.
+
+        Returns None if the dimensions of the export packages of any item are unknown."""
         ret = []
         for box in self.itemlist:
-            ret.extend(box.export_karton_gewichte)
+            packages = box.export_karton_packages
+            if packages is None:
+                return None
+            ret.extend(packages)
         return ret
 
+    def beladene_paletten(self, pallettype=EUROPALETTE):
+        """Packs the export packages onto pallets. See pallet.build_pallets() for the return value."""
+        packages = self.export_karton_packages
+        if packages is None:
+            raise ValueError("export package dimensions unknown for %r" % self)
+        return build_pallets(packages, pallettype)
+
+    @property
+    def europaletten(self):
+        """Returns the number of euro pallets needed to ship the export packages.
+
+        In contrast to versandpaletten this is based on the actual dimensions and weights of the packages.
+        Returns None if the dimensions of the export packages are unknown."""
+        packages = self.export_karton_packages
+        if packages is None:
+            return None
+        return count_pallets(packages, EUROPALETTE)
+
     @property
     def kep(self):
         """Entscheidet, ob die Sendung mit einem Paketdienstleister verchickt werden kann."""
-        if self.export_kartons > 10:
-            return False
-        if self.max_packstueck_gewicht > 31500:
-            return False
-        return True
+        return self.versandregeln.kep(self.export_kartons, self.max_packstueck_gewicht, self.max_gurtmass)
+
+
+def _iter_kompakt(kompakt):
+    """Expands the compact form of export_karton_gewichte lazily."""
+    voll, anzahl, rest = kompakt
+    if rest is None:
+        return itertools.repeat(voll, anzahl)
+    return itertools.chain(itertools.repeat(voll, anzahl), [rest])
+
+
+_SUMMEN = ('volumen', 'gewicht', 'paletten', 'picks', 'packstuecke', 'export_kartons')
+
+
+def _aggregate(itemlist):
+    """Calculates the aggregates used by AbstractLieferung in a single pass over itemlist."""
+    ret = dict.fromkeys(_SUMMEN, 0)
+    ret['anbruch'] = False
+    ret['max_packstueck_gewicht'] = 0
+    ret['max_gurtmass'] = 0
+    for item in itemlist:
+        for name in _SUMMEN:
+            if not isinstance(ret[name], Exception):
+                try:
+                    ret[name] += getattr(item, name)
+                except Exception, exception:
+                    ret[name] = exception
+        # like any() - items after the first Anbruch are not looked at
+        if ret['anbruch'] is False:
+            try:
+                ret['anbruch'] = bool(item.anbruch)
+            except Exception, exception:
+                ret['anbruch'] = exception
+        if not isinstance(ret['max_packstueck_gewicht'], Exception):
+            try:
+                ret['max_packstueck_gewicht'] = max(ret['max_packstueck_gewicht'], item.max_packstueck_gewicht)
+            except Exception, exception:
+                ret['max_packstueck_gewicht'] = exception
+        if not isinstance(ret['max_gurtmass'], Exception):
+            try:
+                ret['max_gurtmass'] = max(ret['max_gurtmass'], item.gurtmass or 0)
+            except Exception, exception:
+                ret['max_gurtmass'] = exception
+    return ret
+
+
+def summarize(lieferungen):
+    """Returns a list with the aggregates (see AbstractLieferung.aggregates()) of each Lieferung.
+
+    Each dict additionally contains the value of kep. Values which can't be calculated are None.
+    """
+    ret = []
+    for lieferung in lieferungen:
+        data = {}
+        for name, value in lieferung.aggregates().items():
+            if isinstance(value, Exception):
+                value = None
+            data[name] = value
+        try:
+            data['kep'] = lieferung.kep
+        except Exception:
+            data['kep'] = None
+        ret.append(data)
+    return ret
 
 
 class simpleTests(unittest.TestCase):
@@ -248,5 +469,136 @@ class simpleTests(unittest.TestCase):
         # print alieferung.transportweg
         # print alieferung.fix
 
+    def test_export_karton_gewichte(self):
+        """The compact form gives the same cartons as packing one by one."""
+
+        def einzeln(item):
+            menge = item.menge
+            ret = []
+            while menge:
+                if menge > item.produkte_pro_exportkarton:
+                    ret.append(item.gewicht_pro_exportkarton)
+                    menge -= item.produkte_pro_exportkarton
+                else:
+                    ret.append(menge * item.einzelgewicht)
+                    menge = 0
+            return ret
+
+        alieferung = AbstractLieferung()
+        for menge in (0, 1, 3, 4, 5, 12, 4001):
+            aitem = AbstractItem()
+            aitem.menge = menge
+            aitem.einzelgewicht = 250
+            aitem.produkte_pro_exportkarton = 4
+            aitem.gewicht_pro_exportkarton = 1100
+            self.assertEqual(aitem.export_karton_gewichte, einzeln(aitem))
+            alieferung.itemlist.append(aitem)
+        self.assertEqual(alieferung.export_karton_gewichte_kompakt[:4],
+                         [(None, 0, None), (None, 0, 250), (None, 0, 750), (None, 0, 1000)])
+        self.assertEqual(alieferung.export_karton_gewichte_kompakt[-1], (1100, 1000, 250))
+        self.assertEqual(alieferung.export_karton_gewichte,
+                         sum([einzeln(x) for x in alieferung.itemlist], []))
+        self.assertEqual(len(alieferung.export_karton_gewichte), 1009)
+
+    def test_aggregate_cache(self):
+        """Cached aggregates are recalculated if the itemlist or a menge changes."""
+        aitem = AbstractItem()
+        aitem.menge = 12
+        aitem.einzelgewicht = 3333
+        aitem.einzelvolumen = 15000
+        aitem.palettenfaktor = 70
+        aitem.produkte_pro_exportkarton = 2
+        aitem.gewicht_pro_exportkarton = 6666
+        alieferung = AbstractLieferung()
+        self.assertEqual(alieferung.gewicht, 0)
+        self.assertEqual(alieferung.max_packstueck_gewicht, 0)
+        alieferung.itemlist.append(aitem)
+        self.assertEqual(alieferung.gewicht, 39996)
+        self.assertEqual(alieferung.anbruch, False)
+        aitem.menge = 13
+        self.assertEqual(alieferung.gewicht, 43329)
+        self.assertEqual(alieferung.anbruch, True)
+        self.assertEqual(alieferung.packstuecke, 7)
+        aitem.einzelgewicht = 1000
+        self.assertEqual(alieferung.gewicht, 43329)
+        alieferung.invalidate()
+        self.assertEqual(alieferung.gewicht, 13000)
+        # errors are raised when accessing the property
+        del aitem.gewicht_pro_exportkarton
+        alieferung.invalidate()
+        self.assertEqual(alieferung.gewicht, 13000)
+        self.assertRaises(AttributeError, getattr, alieferung, 'max_packstueck_gewicht')
+
+        summary = summarize([alieferung, AbstractLieferung()])
+        self.assertEqual(summary[0]['gewicht'], 13000)
+        self.assertEqual(summary[0]['max_packstueck_gewicht'], None)
+        self.assertEqual(summary[0]['kep'], None)
+        self.assertEqual(summary[1]['kep'], True)
+
+    def test_aggregate_cache_identity(self):
+        """Items which compare equal (e.g. model instances with the same pk) are still different items."""
+
+        class EqualItem(AbstractItem):
+            def __eq__(self, other):
+                return True
+
+            def __ne__(self, other):
+                return False
+
+        alieferung = AbstractLieferung()
+        for einzelgewicht in (100, 200):
+            aitem = EqualItem()
+            aitem.menge = 1
+            aitem.einzelgewicht = einzelgewicht
+            alieferung.itemlist = [aitem]
+            self.assertEqual(alieferung.gewicht, einzelgewicht)
+
+    def test_transportweg(self):
+        """Choosing the method of shipping."""
+        aitem = AbstractItem()
+        aitem.menge = 4
+        aitem.einzelgewicht = 5000
+        aitem.gewicht_pro_exportkarton = 10000
+        aitem.palettenfaktor = 80
+        aitem.produkte_pro_exportkarton = 2
+        alieferung = AbstractLieferung()
+        alieferung.itemlist = [aitem]
+        self.assertEqual(alieferung.max_gurtmass, 0)
+        self.assertEqual((alieferung.kep, alieferung.transportweg), (True, KEP))
+        aitem.exportkarton_abmessungen = '1200x600x400'
+        alieferung.invalidate()
+        self.assertEqual(alieferung.max_gurtmass, 3200)
+        self.assertEqual((alieferung.kep, alieferung.transportweg), (False, FRACHT))
+        aitem.menge = 24
+        self.assertEqual(alieferung.transportweg, FRACHT)
+        aitem.menge = 80 * 33
+        self.assertEqual(alieferung.transportweg, KOMPLETTLADUNG)
+        alieferung.versandregeln = Versandregeln(komplettladung_paletten=34, kep_max_gurtmass=4000)
+        self.assertEqual(alieferung.transportweg, FRACHT)
+        aitem.menge = 4
+        self.assertEqual(alieferung.transportweg, KEP)
+
+    def test_paletten(self):
+        """Pallet building based on export package dimensions."""
+        aitem = AbstractItem()
+        aitem.menge = 100
+        aitem.einzelgewicht = 6000
+        aitem.gewicht_pro_exportkarton = 12000
+        aitem.palettenfaktor = 70
+        aitem.produkte_pro_exportkarton = 2
+        alieferung = AbstractLieferung()
+        alieferung.itemlist = [aitem]
+        self.assertEqual(alieferung.export_karton_packages, None)
+        self.assertEqual(alieferung.europaletten, None)
+        self.assertRaises(ValueError, alieferung.beladene_paletten)
+        aitem.exportkarton_abmessungen = '580x400x300'
+        self.assertEqual(len(alieferung.export_karton_packages), 50)
+        self.assertEqual(alieferung.versandpaletten, 2)
+        self.assertEqual(alieferung.europaletten, 3)
+        pallets, toobig = alieferung.beladene_paletten()
+        self.assertEqual(sum([len(x) for x in pallets]), 50)
+
 if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
     unittest.main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+shipmenttable.py - columnar representation of many Lieferungen for bulk planning.
+
+ShipmentTable keeps the attributes of all Items of many Lieferungen in NumPy arrays and calculates the
+values known from shipment.AbstractLieferung for all Lieferungen at once. The results match the ones
+of AbstractLieferung exactly.
+
+Requires NumPy. You might consider this BSD-Licensed.
+"""
+
+import unittest
+import numpy
+from pyshipping.shipment import VERSANDREGELN, KEP, FRACHT, KOMPLETTLADUNG
+
+
+def _integral(values):
+    """Boolean array telling for each value if it is an integer.
+
+    Columns mixing ints and floats are stored as float arrays, so for sequences this is decided by the
+    type of each value.
+    """
+    if isinstance(values, numpy.ndarray):
+        return numpy.repeat(issubclass(values.dtype.type, numpy.integer), len(values))
+    return numpy.array([isinstance(value, (int, long, numpy.integer)) for value in values], dtype=bool)
+
+
+def _divide(dividend, divisor, integral):
+    """Divides like Python 2 does: integer division where integral is set, true division otherwise."""
+    if integral.all():
+        return numpy.floor_divide(dividend, divisor)
+    if not integral.any():
+        return numpy.true_divide(dividend, divisor)
+    return numpy.where(integral, numpy.floor_divide(dividend, divisor), numpy.true_divide(dividend, divisor))
+
+
+def _roundup(values):
+    """Rounds up like AbstractItem.picks: non integral values v become int(v + 1)."""
+    truncated = numpy.trunc(values)
+    return numpy.where(values != truncated, numpy.trunc(values + 1), values)
+
+
+class ShipmentTable(object):
+    """Items of many Lieferungen stored column by column.
+
+    `lieferung` is an array giving for each Item (row) the number of the Lieferung it belongs to. Items
+    of a Lieferung should be in the same order as in the itemlist to get exactly the same floating point
+    results as AbstractLieferung. All other columns correspond to the attributes of AbstractItem,
+    gurtmass is the gurtmass of the export package or 0 if unknown.
+    """
+
+    versandregeln = VERSANDREGELN
+
+    def __init__(self, lieferung, menge, einzelgewicht, einzelvolumen, palettenfaktor,
+                 produkte_pro_exportkarton, gewicht_pro_exportkarton=None, gurtmass=None,
+                 anzahl_lieferungen=None):
+        self.lieferung = numpy.asarray(lieferung, dtype=numpy.intp)
+        self.menge = numpy.asarray(menge)
+        self.einzelgewicht = numpy.asarray(einzelgewicht)
+        self.einzelvolumen = numpy.asarray(einzelvolumen)
+        self.palettenfaktor = numpy.asarray(palettenfaktor)
+        self.produkte_pro_exportkarton = numpy.asarray(produkte_pro_exportkarton)
+        if gewicht_pro_exportkarton is None:
+            gewicht_integral = _integral(einzelgewicht)
+            gewicht_pro_exportkarton = self.einzelgewicht * self.produkte_pro_exportkarton
+        else:
+            gewicht_integral = _integral(gewicht_pro_exportkarton)
+        self.gewicht_pro_exportkarton = numpy.asarray(gewicht_pro_exportkarton)
+        # rows where max_packstueck_gewicht uses integer division
+        self._integral_division = gewicht_integral & _integral(produkte_pro_exportkarton)
+        if gurtmass is None:
+            gurtmass = numpy.zeros(self.lieferung.shape, dtype=numpy.intp)
+        self.gurtmass = numpy.asarray(gurtmass)
+        if anzahl_lieferungen is None:
+            if len(self.lieferung):
+                anzahl_lieferungen = int(self.lieferung.max()) + 1
+            else:
+                anzahl_lieferungen = 0
+        self.anzahl_lieferungen = anzahl_lieferungen
+        for column in (self.menge, self.einzelgewicht, self.einzelvolumen, self.palettenfaktor,
+                       self.produkte_pro_exportkarton, self.gewicht_pro_exportkarton, self.gurtmass):
+            if column.shape != self.lieferung.shape:
+                raise ValueError("all columns must have the same length as lieferung")
+
+    @classmethod
+    def from_lieferungen(cls, lieferungen):
+        """Creates a ShipmentTable from a sequence of AbstractLieferung objects."""
+        columns = dict(lieferung=[], menge=[], einzelgewicht=[], einzelvolumen=[], palettenfaktor=[],
+                       produkte_pro_exportkarton=[], gewicht_pro_exportkarton=[], gurtmass=[])
+        anzahl = 0
+        for nummer, lieferung in enumerate(lieferungen):
+            anzahl += 1
+            for item in lieferung.itemlist:
+                columns['lieferung'].append(nummer)
+                for name in ('menge', 'einzelgewicht', 'einzelvolumen', 'palettenfaktor',
+                             'produkte_pro_exportkarton', 'gewicht_pro_exportkarton'):
+                    columns[name].append(getattr(item, name))
+                columns['gurtmass'].append(item.gurtmass or 0)
+        return cls(anzahl_lieferungen=anzahl, **columns)
+
+    def __len__(self):
+        return self.anzahl_lieferungen
+
+    def _max(self, values):
+        """Maximum of values per Lieferung, 0 for Lieferungen without Items."""
+        ret = numpy.zeros(self.anzahl_lieferungen, dtype=values.dtype)
+        if len(values):
+            ret.fill(values.min())
+            numpy.maximum.at(ret, self.lieferung, values)
+            ret[numpy.bincount(self.lieferung, minlength=self.anzahl_lieferungen) == 0] = 0
+        return ret
+
+    def _sum(self, values):
+        """Sums up values per Lieferung, in row order."""
+        ret = numpy.zeros(self.anzahl_lieferungen, dtype=values.dtype)
+        numpy.add.at(ret, self.lieferung, values)
+        return ret
+
+    @property
+    def anbruch(self):
+        """Boolean array: does the Lieferung contain Items needing an export package to be opened."""
+        anbruch = numpy.remainder(self.menge, self.produkte_pro_exportkarton) != 0
+        return self._sum(anbruch.astype(numpy.intp)) > 0
+
+    @property
+    def volumen(self):
+        """Volume of each Lieferung."""
+        return self._sum(self.menge * self.einzelvolumen)
+
+    @property
+    def gewicht(self):
+        """Weight of each Lieferung in g."""
+        return self._sum(self.menge * self.einzelgewicht)
+
+    @property
+    def max_packstueck_gewicht(self):
+        """Weight of the heaviest package of each Lieferung in g, 0 for Lieferungen without Items."""
+        values = numpy.where(self.menge >= self.produkte_pro_exportkarton,
+                             self.gewicht_pro_exportkarton,
+                             _divide(self.gewicht_pro_exportkarton, self.produkte_pro_exportkarton,
+                                     self._integral_division)
+                             * self.menge)
+        return self._max(values)
+
+    @property
+    def max_gurtmass(self):
+        """Highest gurtmass of the export packages of each Lieferung, 0 if unknown."""
+        return self._max(self.gurtmass)
+
+    @property
+    def paletten(self):
+        """Number of pallets of each Lieferung as float."""
+        return self._sum(numpy.true_divide(self.menge, self.palettenfaktor))
+
+    @property
+    def versandpaletten(self):
+        """Number of pallets to be shipped for each Lieferung."""
+        return numpy.ceil(self.paletten)
+
+    @property
+    def picks(self):
+        """Estimated number of picks of each Lieferung."""
+        return self._sum(_roundup(numpy.true_divide(self.menge, self.palettenfaktor)))
+
+    @property
+    def export_kartons(self):
+        """Estimated number of export packages of each Lieferung as float."""
+        return self._sum(numpy.true_divide(self.menge, self.produkte_pro_exportkarton))
+
+    @property
+    def packstuecke(self):
+        """Number of packages of each Lieferung as integer."""
+        packstuecke = _roundup(numpy.true_divide(self.menge, self.produkte_pro_exportkarton))
+        return self._sum(packstuecke.astype(numpy.int64))
+
+    @property
+    def kep(self):
+        """Boolean array: can the Lieferung be shipped by a parcel service (see AbstractLieferung.kep)."""
+        return self.versandregeln.kep(self.export_kartons, self.max_packstueck_gewicht, self.max_gurtmass)
+
+    @property
+    def transportweg(self):
+        """Array with the suggested method of shipping (see AbstractLieferung.transportweg)."""
+        regeln = self.versandregeln
+        komplettladung = regeln.komplettladung(self.versandpaletten, self.gewicht)
+        kep = regeln.kep(self.export_kartons, self.max_packstueck_gewicht, self.max_gurtmass)
+        return numpy.where(komplettladung, KOMPLETTLADUNG, numpy.where(kep, KEP, FRACHT))
+
+
+class ShipmentTableTests(unittest.TestCase):
+    """Compare ShipmentTable with AbstractLieferung."""
+
+    def setUp(self):
+        # (menge, einzelgewicht, einzelvolumen, palettenfaktor, produkte_pro_exportkarton,
+        #  gewicht_pro_exportkarton)
+        data = [[(12, 3333, 15000, 70, 2, 6666), (17, 9123, 15000, 30, 5, 45615)],
+                [],
+                [(3, 250.5, 0.003, 700, 10, 2600), (60, 1000, 0.01, 60, 6, 6000)],
+                [(100, 9500, 0.2, 20, 1, 9500)],
+                [(7, 900, 0.01, 7, 10, 9000)],
+                [(3000, 8000, 0.01, 80, 1, 8000)],
+                [(2, 900, 0.01, 7, 1, 900, '1200x600x400')]]
+        self.lieferungen = self.make_lieferungen(data)
+        self.table = ShipmentTable.from_lieferungen(self.lieferungen)
+
+    def make_lieferungen(self, data):
+        from pyshipping.shipment import AbstractItem, AbstractLieferung
+        lieferungen = []
+        for itemdata in data:
+            lieferung = AbstractLieferung()
+            for values in itemdata:
+                item = AbstractItem()
+                (item.menge, item.einzelgewicht, item.einzelvolumen, item.palettenfaktor,
+                 item.produkte_pro_exportkarton, item.gewicht_pro_exportkarton) = values[:6]
+                item.exportkarton_abmessungen = values[6:] and values[6] or None
+                lieferung.itemlist.append(item)
+            lieferungen.append(lieferung)
+        return lieferungen
+
+    def test_matches_scalar(self):
+        """All values match the ones calculated by AbstractLieferung."""
+        self.assertEqual(len(self.table), 7)
+        for name in ('anbruch', 'volumen', 'gewicht', 'max_packstueck_gewicht', 'max_gurtmass', 'paletten',
+                     'versandpaletten', 'picks', 'packstuecke', 'export_kartons', 'kep', 'transportweg'):
+            self.assertEqual(list(getattr(self.table, name)),
+                             [getattr(lieferung, name) for lieferung in self.lieferungen], name)
+
+    def test_mixed_types(self):
+        """Columns mixing ints and floats divide like Python 2 row by row."""
+        lieferungen = self.make_lieferungen([[(1, 1500, 0.01, 70, 4, 6001)],
+                                             [(1, 650.125, 0.01, 70, 4, 2600.5)],
+                                             [(1, 650, 0.01, 70, 4.0, 2601)]])
+        table = ShipmentTable.from_lieferungen(lieferungen)
+        self.assertEqual(list(table.max_packstueck_gewicht),
+                         [lieferung.max_packstueck_gewicht for lieferung in lieferungen])
+        self.assertEqual(list(table.max_packstueck_gewicht), [1500, 650.125, 650.25])
+
+    def test_empty(self):
+        """A table without Items."""
+        table = ShipmentTable([], [], [], [], [], [])
+        self.assertEqual(len(table), 0)
+        self.assertEqual(list(table.gewicht), [])
+        self.assertEqual(list(table.max_packstueck_gewicht), [])
+        self.assertEqual(list(table.transportweg), [])
+        self.assertRaises(ValueError, ShipmentTable, [0, 1], [1], [1], [1], [1], [1])
+
+    def test_transportweg(self):
+        """All methods of shipping are suggested."""
+        self.assertEqual(list(self.table.transportweg),
+                         [FRACHT, KEP, FRACHT, FRACHT, KEP, KOMPLETTLADUNG, FRACHT])
+
+
+if __name__ == '__main__':
+    unittest.main()